@@ -18,7 +18,7 @@ import os
 import sys
 from importlib.util import module_from_spec, spec_from_file_location
 from pathlib import Path
-from flask import Blueprint, Flask
+from flask import Blueprint, Flask, request
 from werkzeug.wrappers.request import Request
 from flask_cors import CORS
 
@@ -33,6 +33,7 @@ from api.settings import SECRET_KEY, stat_logger
 from api.settings import API_VERSION, access_logger
 from api.utils.api_utils import server_error_response
 from itsdangerous.url_safe import URLSafeTimedSerializer as Serializer
+from rag.utils import ELASTICSEARCH
 
 __all__ = ['app']
 
@@ -115,6 +116,20 @@ def load_user(web_request):
         return None
 
 
+@app.before_request
+def _es_deadline():
+    # The ES calls made for a request share its deadline. A client may ask
+    # for a shorter one with X-Request-Timeout, in seconds.
+    timeouts = [ELASTICSEARCH.request_deadline]
+    try:
+        timeouts.append(float(request.headers.get("X-Request-Timeout", 0)))
+    except ValueError:
+        pass
+    timeouts = [t for t in timeouts if t > 0]
+    ELASTICSEARCH.setDeadline(min(timeouts) if timeouts else None)
+
+
 @app.teardown_request
 def _db_close(exc):
-    close_connection()
\ No newline at end of file
+    close_connection()
+    ELASTICSEARCH.setDeadline(None)
\ No newline at end of file
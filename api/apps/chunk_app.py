@@ -21,6 +21,7 @@ from elasticsearch_dsl import Q
 
 from rag.app.qa import rmPrefix, beAdoc
 from rag.nlp import search, huqie
+from rag.nlp.retrieval_cache import RETRIEVAL_CACHE
 from rag.utils import ELASTICSEARCH, rmSpace
 from api.db import LLMType, ParserType
 from api.db.services.knowledgebase_service import KnowledgebaseService
@@ -153,10 +154,14 @@ def set():
             d = beAdoc(d, arr[0], arr[1], not any(
                 [huqie.is_chinese(t) for t in q + a]))
 
+        # title_tks is not part of this partial update, so let rerank() fall
+        # back to the tokens instead of storing terms without the title.
+        d["rank_terms_with_weight"] = None
         v, c = embd_mdl.encode([doc.name, req["content_with_weight"]])
         v = 0.1 * v[0] + 0.9 * v[1] if doc.parser_id != ParserType.QA else v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        RETRIEVAL_CACHE.invalidate([doc.kb_id])
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -174,6 +179,7 @@ def switch():
         if not ELASTICSEARCH.upsert([{"id": i, "available_int": int(req["available_int"])} for i in req["chunk_ids"]],
                                     search.index_name(tenant_id)):
             return get_data_error_result(retmsg="Index updating failure")
+        RETRIEVAL_CACHE.invalidate(tenant_id=tenant_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -188,6 +194,7 @@ def rm():
         if not ELASTICSEARCH.deleteByQuery(
                 Q("ids", values=req["chunk_ids"]), search.index_name(current_user.id)):
             return get_data_error_result(retmsg="Index updating failure")
+        RETRIEVAL_CACHE.invalidate(tenant_id=current_user.id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -216,6 +223,7 @@ def create():
         d["kb_id"] = [doc.kb_id]
         d["docnm_kwd"] = doc.name
         d["doc_id"] = doc.id
+        d["rank_terms_with_weight"] = retrievaler.rank_terms(d)
 
         tenant_id = DocumentService.get_tenant_id(req["doc_id"])
         if not tenant_id:
@@ -228,6 +236,7 @@ def create():
         v = 0.1 * v[0] + 0.9 * v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        RETRIEVAL_CACHE.invalidate([doc.kb_id])
         return get_json_result(data={"chunk_id": chunck_id})
     except Exception as e:
         return server_error_response(e)
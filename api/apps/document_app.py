@@ -24,6 +24,7 @@ from elasticsearch_dsl import Q
 from flask import request
 from flask_login import login_required, current_user
 from rag.nlp import search
+from rag.nlp.retrieval_cache import RETRIEVAL_CACHE
 from rag.utils import ELASTICSEARCH
 from api.db.services import duplicate_name
 from api.db.services.knowledgebase_service import KnowledgebaseService
@@ -207,6 +208,7 @@ def change_status():
                                               idxnm=search.index_name(
                                                   kb.tenant_id)
                                               )
+        RETRIEVAL_CACHE.invalidate([doc.kb_id])
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -258,6 +260,7 @@ def run():
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+            RETRIEVAL_CACHE.invalidate(tenant_id=tenant_id)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -352,6 +355,7 @@ def change_parser():
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+            RETRIEVAL_CACHE.invalidate([doc.kb_id])
 
         return get_json_result(data=True)
     except Exception as e:
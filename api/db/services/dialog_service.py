@@ -140,8 +140,9 @@ def chat(dialog, messages, **kwargs):
         answer, idx = retrievaler.insert_citations(answer,
                                                    [ck["content_ltks"]
                                                        for ck in kbinfos["chunks"]],
-                                                   [ck["vector"]
-                                                       for ck in kbinfos["chunks"]],
+                                                   retrievaler.fetch_vectors([ck["chunk_id"]
+                                                                              for ck in kbinfos["chunks"]],
+                                                                             index_name(dialog.tenant_id)),
                                                    embd_mdl,
                                                    tkweight=1 - dialog.vector_similarity_weight,
                                                    vtweight=dialog.vector_similarity_weight)
@@ -20,6 +20,7 @@ from api.db.db_models import DB, Knowledgebase, Tenant
 from api.db.db_models import Document
 from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
+from rag.nlp.retrieval_cache import RETRIEVAL_CACHE
 from api.db import StatusEnum
 
 
@@ -102,7 +103,7 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
+    def get_unfinished_docs(cls, doc_ids=None):
         fields = [cls.model.id, cls.model.process_begin_at]
         docs = cls.model.select(*fields) \
             .where(
@@ -110,6 +111,8 @@ class DocumentService(CommonService):
                 ~(cls.model.type == FileType.VIRTUAL.value),
                 cls.model.progress < 1,
                 cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(list(doc_ids)))
         return list(docs.dicts())
 
     @classmethod
@@ -128,6 +131,7 @@ class DocumentService(CommonService):
             chunk_num=Knowledgebase.chunk_num +
             chunk_num).where(
             Knowledgebase.id == kb_id).execute()
+        RETRIEVAL_CACHE.invalidate([kb_id])
         return num
 
     @classmethod
@@ -13,6 +13,8 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+from peewee import fn
+
 from api.db import StatusEnum, TenantPermission
 from api.db.db_models import Knowledgebase, DB, Tenant
 from api.db.services.common_service import CommonService
@@ -89,6 +91,20 @@ class KnowledgebaseService(CommonService):
         dfs_update(m.parser_config, config)
         cls.update_by_id(id, {"parser_config": m.parser_config})
 
+    @classmethod
+    @DB.connection_context()
+    def get_chunk_num_by_tenant(cls, tenant_id):
+        return cls.model.select(fn.SUM(cls.model.chunk_num)).where(
+            cls.model.tenant_id == tenant_id).scalar() or 0
+
+    @classmethod
+    @DB.connection_context()
+    def get_chunk_num_of_tenants(cls, min_chunk_num=0):
+        # (tenant id, chunks) of the tenants with at least min_chunk_num chunks.
+        total = fn.SUM(cls.model.chunk_num)
+        return [(t, int(n)) for t, n in cls.model.select(cls.model.tenant_id, total)
+                .group_by(cls.model.tenant_id).having(total >= min_chunk_num).tuples()]
+
     @classmethod
     @DB.connection_context()
     def get_field_map(cls, ids):
@@ -15,7 +15,11 @@
 #
 from api.db.services.user_service import TenantService
 from api.settings import database_logger
+import numpy as np
+
 from rag.llm import EmbeddingModel, CvModel, ChatModel
+from rag.llm.embedding_cache import EMBEDDING_CACHE, QUERY_EMBEDDING_CACHE
+from rag.utils import num_tokens_from_string
 from api.db import LLMType
 from api.db.db_models import DB, UserTenant
 from api.db.db_models import LLMFactories, LLM, TenantLLM
@@ -144,16 +148,43 @@ class LLMBundle(object):
         assert self.mdl, "Can't find mole for {}/{}/{}".format(
             tenant_id, llm_type, llm_name)
 
+    def cache_key(self):
+        # Models of the same name behind different endpoints, e.g. the
+        # self-hosted ones of two tenants, may not share their embeddings.
+        key = "{}/{}".format(self.mdl.__class__.__name__,
+                             getattr(self.mdl, "model_name", self.llm_name))
+        base_url = getattr(self.mdl, "base_url", None)
+        return "{}@{}".format(key, base_url) if base_url else key
+
     def encode(self, texts: list, batch_size=32):
-        emd, used_tokens = self.mdl.encode(texts, batch_size)
+        # Only the texts missing from the cache go to the model and are billed,
+        # the tokens of the cached ones are still counted for the document.
+        model = self.cache_key()
+        vects = EMBEDDING_CACHE.get(model, texts)
+        missed = [i for i, v in enumerate(vects) if v is None]
+        used_tokens = sum([num_tokens_from_string(texts[i]) for i, v in enumerate(vects) if v is not None])
+        if not missed:
+            return np.array(vects), used_tokens
+
+        emd, tks = self.mdl.encode([texts[i] for i in missed], batch_size)
+        EMBEDDING_CACHE.put(model, [texts[i] for i in missed], emd)
+        for i, v in zip(missed, emd):
+            vects[i] = v
         if not TenantLLMService.increase_usage(
-                self.tenant_id, self.llm_type, used_tokens):
+                self.tenant_id, self.llm_type, tks):
             database_logger.error(
                 "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
-        return emd, used_tokens
+        return np.array(vects), used_tokens + tks
 
     def encode_queries(self, query: str):
+        # A cached query isn't sent to the model, so it isn't billed.
+        model = "{}/{}".format(self.tenant_id, self.cache_key())
+        emd = QUERY_EMBEDDING_CACHE.get(model, [query])[0]
+        if emd is not None:
+            return emd, num_tokens_from_string(query)
+
         emd, used_tokens = self.mdl.encode_queries(query)
+        QUERY_EMBEDDING_CACHE.put(model, [query], [emd])
         if not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
@@ -21,6 +21,14 @@ from api.db import StatusEnum, FileType, TaskStatus
 from api.db.db_models import Task, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
+from api.utils import current_timestamp
+from rag.utils.redis_conn import REDIS_CONN
+
+# How many candidates a worker looks at when it claims tasks.
+CLAIM_WINDOW = 32
+REQUEUE_MSG = "Task has been re-queued."
+# Redis set of the ids of tasks whose progress changed, drained by the task broker.
+PROGRESS_CHANGED = "ragflow:task:progress_changed"
 
 
 class TaskService(CommonService):
@@ -47,28 +55,91 @@ class TaskService(CommonService):
             Tenant.img2txt_id,
             Tenant.asr_id,
             cls.model.update_time]
-        with DB.lock("get_task", -1):
-            docs = cls.model.select(*fields) \
-                .join(Document, on=(cls.model.doc_id == Document.id)) \
-                .join(Knowledgebase, on=(Document.kb_id == Knowledgebase.id)) \
-                .join(Tenant, on=(Knowledgebase.tenant_id == Tenant.id))\
-                .where(
-                    Document.status == StatusEnum.VALID.value,
-                    Document.run == TaskStatus.RUNNING.value,
-                    ~(Document.type == FileType.VIRTUAL.value),
-                    cls.model.progress == 0,
-                    #cls.model.update_time >= tm,
-                    #(Expression(cls.model.create_time, "%%", comm) == mod)
-                )\
-                .order_by(cls.model.update_time.asc())\
-                .paginate(0, items_per_page)
-            docs = list(docs.dicts())
-            if not docs: return []
-            if not takeit: return docs
+        docs = cls.model.select(*fields) \
+            .join(Document, on=(cls.model.doc_id == Document.id)) \
+            .join(Knowledgebase, on=(Document.kb_id == Knowledgebase.id)) \
+            .join(Tenant, on=(Knowledgebase.tenant_id == Tenant.id))\
+            .where(
+                Document.status == StatusEnum.VALID.value,
+                Document.run == TaskStatus.RUNNING.value,
+                ~(Document.type == FileType.VIRTUAL.value),
+                cls.model.progress == 0,
+                #cls.model.update_time >= tm,
+                #(Expression(cls.model.create_time, "%%", comm) == mod)
+            )\
+            .order_by(cls.model.update_time.asc())\
+            .paginate(0, max(items_per_page, CLAIM_WINDOW))
+        docs = list(docs.dicts())
+        if not docs: return []
+        if not takeit: return docs[:items_per_page]
+
+        # Claim by compare-and-set instead of a global lock: the update only
+        # matches while the task is still unclaimed, so exactly one worker wins
+        # it and the others move on to the next candidate.
+        random.shuffle(docs)
+        claimed = []
+        for d in docs:
+            if len(claimed) >= items_per_page:
+                break
+            if cls.model.update(progress_msg=cls.model.progress_msg + "\n" + "Task has been received.", progress=random.random()/10.).where(
+                    cls.model.id == d["id"], cls.model.progress == 0).execute():
+                claimed.append(d)
+        cls.publish_progress([d["id"] for d in claimed])
+        return claimed
+
+    @classmethod
+    def publish_progress(cls, ids):
+        if ids and REDIS_CONN.is_alive():
+            REDIS_CONN.sadd(PROGRESS_CHANGED, *ids)
 
-            cls.model.update(progress_msg=cls.model.progress_msg + "\n" + "Task has been received.", progress=random.random()/10.).where(
-                cls.model.id == docs[0]["id"]).execute()
-            return docs
+    @classmethod
+    @DB.connection_context()
+    def get_doc_ids(cls, ids):
+        tasks = cls.model.select(cls.model.id, cls.model.doc_id).where(cls.model.id.in_(list(ids)))
+        return {t.id: t.doc_id for t in tasks}
+
+    @classmethod
+    @DB.connection_context()
+    def get_by_doc_ids(cls, doc_ids):
+        return list(cls.model.select().where(cls.model.doc_id.in_(list(doc_ids)))
+                    .order_by(cls.model.create_time.asc()))
+
+    @classmethod
+    @DB.connection_context()
+    def heartbeat(cls, ids):
+        """
+        Keep the tasks being worked on visible as alive for requeue_stale.
+        """
+        if not ids: return 0
+        return cls.model.update(update_time=current_timestamp()).where(
+            cls.model.id.in_(list(ids)), cls.model.progress > 0, cls.model.progress < 1).execute()
+
+    @classmethod
+    @DB.connection_context()
+    def requeue_stale(cls, timeout, max_retries=3):
+        """
+        Put the claimed tasks that have not shown any sign of life for
+        `timeout` seconds back in the queue, e.g. when their executor crashed.
+        A task re-queued `max_retries` times is failed instead.
+        """
+        deadline = current_timestamp() - int(timeout * 1000)
+        stale = cls.model.select(cls.model.id, cls.model.progress_msg).where(
+            cls.model.progress > 0, cls.model.progress < 1, cls.model.update_time < deadline)
+        num, ids = 0, []
+        for t in stale:
+            if (t.progress_msg or "").count(REQUEUE_MSG) >= max_retries:
+                info = {"progress": -1,
+                        "progress_msg": cls.model.progress_msg + "\n" + "[ERROR]Task timeout, re-queued too many times."}
+            else:
+                info = {"progress": 0,
+                        "progress_msg": cls.model.progress_msg + "\n" + REQUEUE_MSG}
+            if cls.model.update(info).where(
+                    cls.model.id == t.id, cls.model.progress > 0, cls.model.progress < 1,
+                    cls.model.update_time < deadline).execute():
+                num += 1
+                ids.append(t.id)
+        cls.publish_progress(ids)
+        return num
 
     @classmethod
     @DB.connection_context()
@@ -84,10 +155,13 @@ class TaskService(CommonService):
     @classmethod
     @DB.connection_context()
     def update_progress(cls, id, info):
-        with DB.lock("update_progress", -1):
-            if info["progress_msg"]:
-                cls.model.update(progress_msg=cls.model.progress_msg + "\n" + info["progress_msg"]).where(
-                    cls.model.id == id).execute()
-            if "progress" in info:
-                cls.model.update(progress=info["progress"]).where(
-                    cls.model.id == id).execute()
+        # A single statement is atomic on its own, no lock needed.
+        data = {}
+        if info["progress_msg"]:
+            data["progress_msg"] = cls.model.progress_msg + "\n" + info["progress_msg"]
+        if "progress" in info:
+            data["progress"] = info["progress"]
+        if not data:
+            return
+        cls.model.update(data).where(cls.model.id == id).execute()
+        cls.publish_progress([id])
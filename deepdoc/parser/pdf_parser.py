@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
+import math
+import multiprocessing
 import os
 import random
+import shutil
+import tempfile
+from collections import OrderedDict
 
 import fitz
 import xgboost as xgb
@@ -17,12 +22,128 @@ from PyPDF2 import PdfReader as pdf2_read
 from api.utils.file_utils import get_project_base_directory
 from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
 from rag.nlp import huqie
+from rag.settings import DEEPDOC
 from copy import deepcopy
 from huggingface_hub import snapshot_download
 
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
 
+_UPDOWN_CNT_MDL = None
+
+
+def updown_cnt_model():
+    """
+    The xgboost model deciding whether to concatenate two text boxes,
+    loaded once per process and shared by all the parsers.
+    """
+    global _UPDOWN_CNT_MDL
+    if _UPDOWN_CNT_MDL is not None:
+        return _UPDOWN_CNT_MDL
+    mdl = xgb.Booster()
+    if torch.cuda.is_available():
+        mdl.set_param({"device": "cuda"})
+    try:
+        model_dir = os.path.join(
+                get_project_base_directory(),
+                "rag/res/deepdoc")
+        mdl.load_model(os.path.join(
+            model_dir, "updown_concat_xgb.model"))
+    except Exception as e:
+        model_dir = snapshot_download(
+            repo_id="InfiniFlow/text_concat_xgb_v1.0",
+            local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
+            local_dir_use_symlinks=False)
+        mdl.load_model(os.path.join(
+            model_dir, "updown_concat_xgb.model"))
+    _UPDOWN_CNT_MDL = mdl
+    return mdl
+
+
+class PageImages:
+    """
+    The page images of a PDF rendered on demand, in place of the list of all
+    of them. At most `cache_size` pages stay in memory. The least recently used
+    ones are spilled to a temporary directory and read back from there, or
+    rendered again if `spill` is off.
+    """
+
+    def __init__(self, fnm, zoomin, page_from, page_to, cache_size=16, spill=True):
+        self.fnm = fnm
+        self.zoomin = zoomin
+        self.page_from = page_from
+        self.is_fitz = False
+        try:
+            self.pdf = pdfplumber.open(fnm) if isinstance(
+                fnm, str) else pdfplumber.open(BytesIO(fnm))
+            self.total_page = len(self.pdf.pages)
+        except Exception as e:
+            self.__open_fitz()
+        self.page_to = max(min(page_to, self.total_page), page_from)
+        self.cache_size = max(cache_size, 1)
+        self.cache = OrderedDict()
+        self.spill_dir = tempfile.mkdtemp(prefix="deepdoc_") if spill else None
+        self.spilled = set([])
+
+    def __open_fitz(self):
+        self.pdf = fitz.open(self.fnm) if isinstance(
+            self.fnm, str) else fitz.open(stream=self.fnm, filetype="pdf")
+        self.total_page = len(self.pdf)
+        self.is_fitz = True
+
+    def __render(self, i):
+        if not self.is_fitz:
+            try:
+                return self.pdf.pages[self.page_from + i].to_image(resolution=72 * self.zoomin).annotated
+            except Exception as e:
+                self.__open_fitz()
+        pix = self.pdf[self.page_from + i].get_pixmap(matrix=fitz.Matrix(self.zoomin, self.zoomin))
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+    def __spill_path(self, i):
+        return os.path.join(self.spill_dir, "%d.png" % i)
+
+    def chars(self, i):
+        if self.is_fitz:
+            return []
+        return self.pdf.pages[self.page_from + i].chars
+
+    def __len__(self):
+        return self.page_to - self.page_from
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("page index out of range")
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+
+        if i in self.spilled:
+            img = Image.open(self.__spill_path(i))
+            img.load()
+        else:
+            img = self.__render(i)
+        self.cache[i] = img
+        while len(self.cache) > self.cache_size:
+            j, im = self.cache.popitem(last=False)
+            if self.spill_dir and j not in self.spilled:
+                im.save(self.__spill_path(j), compress_level=1)
+                self.spilled.add(j)
+        return img
+
+    def __del__(self):
+        if getattr(self, "spill_dir", None):
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
 class HuParser:
     def __init__(self):
         self.ocr = OCR()
@@ -32,23 +153,7 @@ class HuParser:
             self.layouter = LayoutRecognizer("layout")
         self.tbl_det = TableStructureRecognizer()
 
-        self.updown_cnt_mdl = xgb.Booster()
-        if torch.cuda.is_available():
-            self.updown_cnt_mdl.set_param({"device": "cuda"})
-        try:
-            model_dir = os.path.join(
-                    get_project_base_directory(),
-                    "rag/res/deepdoc")
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
-        except Exception as e:
-            model_dir = snapshot_download(
-                repo_id="InfiniFlow/text_concat_xgb_v1.0",
-                local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
-                local_dir_use_symlinks=False)
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
-
+        self.updown_cnt_mdl = updown_cnt_model()
 
         self.page_from = 0
         """
@@ -263,7 +368,8 @@ class HuParser:
                 b["SP"] = ii
 
     def __ocr(self, pagenum, img, chars, ZM=3):
-        bxs = self.ocr.detect(np.array(img))
+        img_np = np.array(img)
+        bxs = self.ocr.detect(img_np)
         if not bxs:
             self.boxes.append([])
             return
@@ -278,7 +384,7 @@ class HuParser:
 
         # merge chars in the same rect
         for c in Recognizer.sort_X_firstly(
-                chars, self.mean_width[pagenum - 1] // 4):
+                chars, self.mean_width[-1] // 4):
             ii = Recognizer.find_overlapped(c, bxs)
             if ii is None:
                 self.lefted_chars.append(c)
@@ -294,14 +400,17 @@ class HuParser:
             else:
                 bxs[ii]["text"] += c["text"]
 
+        boxes_to_reg = []
         for b in bxs:
             if not b["text"]:
                 left, right, top, bott = b["x0"] * ZM, b["x1"] * \
                     ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["text"] = self.ocr.recognize(np.array(img),
-                                               np.array([[left, top], [right, top], [right, bott], [left, bott]],
-                                                        dtype=np.float32))
+                boxes_to_reg.append((b, np.array([[left, top], [right, top], [right, bott], [left, bott]],
+                                                 dtype=np.float32)))
             del b["txt"]
+        texts = self.ocr.recognize_batch(img_np, [box for _, box in boxes_to_reg])
+        for (b, _), t in zip(boxes_to_reg, texts):
+            b["text"] = t
         bxs = [b for b in bxs if b["text"]]
         if self.mean_height[-1] == 0:
             self.mean_height[-1] = np.median([b["bottom"] - b["top"]
@@ -926,17 +1035,16 @@ class HuParser:
                 stream=fnm, filetype="pdf")
             return len(pdf)
 
-    def __images__(self, fnm, zoomin=3, page_from=0,
-                   page_to=299, callback=None):
-        self.lefted_chars = []
-        self.mean_height = []
-        self.mean_width = []
-        self.boxes = []
-        self.garbages = {}
-        self.page_cum_height = [0]
-        self.page_layout = []
-        self.page_from = page_from
-        st = timer()
+    def _render_pages(self, fnm, zoomin, page_from, page_to):
+        cache_size = int(DEEPDOC.get("page_cache_size", 0))
+        if cache_size > 0:
+            self.page_images = PageImages(fnm, zoomin, page_from, page_to, cache_size,
+                                          DEEPDOC.get("page_spill", True))
+            self.page_chars = [[c for c in self.page_images.chars(i) if self._has_color(c)]
+                               for i in range(len(self.page_images))]
+            self.pdf = self.page_images.pdf
+            self.total_page = self.page_images.total_page
+            return
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
@@ -964,6 +1072,77 @@ class HuParser:
                 self.page_images.append(img)
                 self.page_chars.append([])
 
+    def _ocr_pages(self, zoomin, page_offset=0):
+        for i, img in enumerate(self.page_images):
+            chars = self.page_chars[i] if not self.is_english else []
+            self.mean_height.append(
+                np.median(sorted([c["height"] for c in chars])) if chars else 0
+            )
+            self.mean_width.append(
+                np.median(sorted([c["width"] for c in chars])) if chars else 8
+            )
+            self.page_cum_height.append(img.size[1] / zoomin)
+            j = 0
+            while j + 1 < len(chars):
+                if chars[j]["text"] and chars[j + 1]["text"] \
+                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                                       chars[j]["width"]) / 2:
+                    chars[j]["text"] += " "
+                j += 1
+
+            self.__ocr(page_offset + i + 1, img, chars, zoomin)
+
+    def _parallel_images(self, fnm, zoomin, page_from, page_to):
+        """
+        Render and OCR page ranges in the page pool and merge the results in
+        page order. Returns False when it is not worth it or not possible,
+        e.g. in a daemonic process, which can not have children.
+        """
+        workers = int(DEEPDOC.get("ocr_workers", 1))
+        if workers <= 1 or multiprocessing.current_process().daemon:
+            return False
+        total_page = self.total_page_number(fnm if isinstance(fnm, str) else None,
+                                            None if isinstance(fnm, str) else fnm)
+        page_to = min(page_to, total_page)
+        if page_to - page_from < 2:
+            return False
+
+        size = math.ceil((page_to - page_from) / min(workers, page_to - page_from))
+        lazy = int(DEEPDOC.get("page_cache_size", 0)) > 0
+        args = [(fnm, zoomin, p, min(p + size, page_to), p - page_from, not lazy)
+                for p in range(page_from, page_to, size)]
+        self.page_images, self.page_chars = [], []
+        for r in page_pool(workers).map(_ocr_page_range, args, chunksize=1):
+            self.page_images.extend(r["page_images"])
+            self.page_chars.extend(r["page_chars"])
+            self.mean_height.extend(r["mean_height"])
+            self.mean_width.extend(r["mean_width"])
+            self.page_cum_height.extend(r["page_height"])
+            self.boxes.extend(r["boxes"])
+            self.lefted_chars.extend(r["lefted_chars"])
+            self.total_page = r["total_page"]
+        if lazy:
+            # The workers only kept their pages for the OCR, render them here on demand.
+            self.page_images = PageImages(fnm, zoomin, page_from, page_to,
+                                          int(DEEPDOC.get("page_cache_size", 0)), DEEPDOC.get("page_spill", True))
+        return True
+
+    def __images__(self, fnm, zoomin=3, page_from=0,
+                   page_to=299, callback=None):
+        self.lefted_chars = []
+        self.mean_height = []
+        self.mean_width = []
+        self.boxes = []
+        self.garbages = {}
+        self.page_cum_height = [0]
+        self.page_layout = []
+        self.page_from = page_from
+        st = timer()
+        ocred = self._parallel_images(fnm, zoomin, page_from, page_to)
+        if not ocred:
+            self._render_pages(fnm, zoomin, page_from, page_to)
+
         self.outlines = []
         try:
             self.pdf = pdf2_read(fnm if isinstance(fnm, str) else BytesIO(fnm))
@@ -993,25 +1172,8 @@ class HuParser:
         self.is_english = False
 
         st = timer()
-        for i, img in enumerate(self.page_images):
-            chars = self.page_chars[i] if not self.is_english else []
-            self.mean_height.append(
-                np.median(sorted([c["height"] for c in chars])) if chars else 0
-            )
-            self.mean_width.append(
-                np.median(sorted([c["width"] for c in chars])) if chars else 8
-            )
-            self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
-
-            self.__ocr(i + 1, img, chars, zoomin)
+        if not ocred:
+            self._ocr_pages(zoomin)
             #if callback:
             #    callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
         #print("OCR:", timer()-st)
@@ -1174,5 +1336,48 @@ class PlainParser(object):
         raise NotImplementedError
 
 
+_PAGE_POOL = None
+_PAGE_PARSER = None
+
+
+def page_pool(workers):
+    """
+    The process pool rendering and OCRing page ranges for HuParser. It is
+    spawned once and kept, so each worker loads the OCR models only once.
+    """
+    global _PAGE_POOL
+    if _PAGE_POOL is None:
+        _PAGE_POOL = multiprocessing.get_context("spawn").Pool(processes=workers)
+    return _PAGE_POOL
+
+
+def _picklable(c):
+    return {k: v for k, v in c.items() if isinstance(v, (str, int, float, bool, tuple, list, type(None)))}
+
+
+def _ocr_page_range(args):
+    global _PAGE_PARSER
+    fnm, zoomin, page_from, page_to, page_offset, keep_images = args
+    if _PAGE_PARSER is None:
+        # Only OCR is needed here, skip loading the other models.
+        _PAGE_PARSER = HuParser.__new__(HuParser)
+        _PAGE_PARSER.ocr = OCR()
+    p = _PAGE_PARSER
+    p.lefted_chars, p.mean_height, p.mean_width, p.boxes, p.page_cum_height = [], [], [], [], []
+    p.is_english = False
+    p._render_pages(fnm, zoomin, page_from, page_to)
+    p._ocr_pages(zoomin, page_offset)
+    return {
+        "page_images": list(p.page_images) if keep_images else [],
+        "page_chars": [[_picklable(c) for c in chars] for chars in p.page_chars],
+        "mean_height": p.mean_height,
+        "mean_width": p.mean_width,
+        "page_height": p.page_cum_height,
+        "boxes": p.boxes,
+        "lefted_chars": [_picklable(c) for c in p.lefted_chars],
+        "total_page": p.total_page
+    }
+
+
 if __name__ == "__main__":
     pass
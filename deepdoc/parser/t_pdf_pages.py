@@ -0,0 +1,62 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import multiprocessing
+import resource
+from timeit import default_timer as timer
+
+from deepdoc.parser.pdf_parser import HuParser
+from rag.settings import DEEPDOC
+
+
+def parse(fnm, page_cache_size, queue):
+    DEEPDOC["page_cache_size"] = page_cache_size
+    st = timer()
+    boxes, tbls = HuParser()(fnm, need_image=True)
+    queue.put((timer() - st, len(boxes), len(tbls), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main(args):
+    # A fresh process per mode, since the peak RSS of a process never goes down.
+    ctx = multiprocessing.get_context("fork")
+    print("{:>16} {:>10} {:>8} {:>8} {:>14}".format("page_cache_size", "seconds", "boxes", "tables", "peak RSS(MB)"))
+    for size in [0, args.page_cache_size]:
+        q = ctx.Queue()
+        proc = ctx.Process(target=parse, args=(args.inputs, size, q))
+        proc.start()
+        el, bxs, tbls, rss = q.get()
+        proc.join()
+        print("{:>16} {:>10.2f} {:>8} {:>8} {:>14.0f}".format(size, el, bxs, tbls, rss / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Peak RSS of parsing a PDF with all the page images in memory versus on demand.")
+    parser.add_argument('--inputs', help="A PDF, preferably a long one", required=True)
+    parser.add_argument('--page_cache_size', help="Pages kept in memory by the on demand mode. Default: 16",
+                        type=int, default=16)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,71 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import threading
+
+import onnxruntime as ort
+
+from rag.settings import DEEPDOC, cron_logger
+
+GRAPH_OPTIMIZATION = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_SESSIONS = {}
+_LOCK = threading.Lock()
+
+
+def _threads(key, default):
+    n = int(DEEPDOC.get(key) or 0)
+    return n if n > 0 else default
+
+
+def session_options(intra_op_num_threads=0, inter_op_num_threads=0, sequential=False, cpu_mem_arena=True):
+    """
+    The options the caller asks for, 0 threads meaning all the cores.
+    deepdoc.intra_op_threads and deepdoc.inter_op_threads override the threads
+    when they are greater than 0, deepdoc.graph_optimization when it is set.
+    """
+    options = ort.SessionOptions()
+    options.enable_cpu_mem_arena = cpu_mem_arena
+    if sequential:
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = _threads("intra_op_threads", intra_op_num_threads)
+    options.inter_op_num_threads = _threads("inter_op_threads", inter_op_num_threads)
+    if DEEPDOC.get("graph_optimization"):
+        options.graph_optimization_level = GRAPH_OPTIMIZATION[DEEPDOC["graph_optimization"]]
+    return options
+
+
+def get_session(model_file_path, *args, **kwargs):
+    """
+    The process wide ONNX session of a model file. It is loaded once and shared
+    by all the parsers, InferenceSession.run being thread safe. The arguments
+    are those of session_options.
+    """
+    with _LOCK:
+        if model_file_path not in _SESSIONS:
+            _SESSIONS[model_file_path] = ort.InferenceSession(
+                model_file_path,
+                sess_options=session_options(*args, **kwargs),
+                providers=['CPUExecutionProvider'])
+            cron_logger.info("ONNX session loaded: {}".format(model_file_path))
+        return _SESSIONS[model_file_path]
+
+
+def clear():
+    with _LOCK:
+        _SESSIONS.clear()
@@ -23,6 +23,7 @@ import numpy as np
 import onnxruntime as ort
 
 from .postprocess import build_post_process
+from .model_registry import get_session
 from rag.settings import cron_logger
 
 
@@ -65,21 +66,15 @@ def load_model(model_dir, nm):
         raise ValueError("not find model file path {}".format(
             model_file_path))
 
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
     if False and ort.get_device() == "GPU":
+        options = ort.SessionOptions()
+        options.enable_cpu_mem_arena = False
         sess = ort.InferenceSession(
             model_file_path,
             options=options,
             providers=['CUDAExecutionProvider'])
     else:
-        sess = ort.InferenceSession(
-            model_file_path,
-            options=options,
-            providers=['CPUExecutionProvider'])
+        sess = get_session(model_file_path)
     return sess, sess.get_inputs()[0]
 
 
@@ -582,6 +577,19 @@ class OCR(object):
             return ""
         return text
 
+    def recognize_batch(self, ori_im, boxes):
+        """
+        Recognize many boxes of one image. The crops go through the text
+        recognizer in width sorted batches instead of one by one.
+        """
+        if not boxes:
+            return []
+        img_crop_list = [self.get_rotate_crop_image(ori_im, box) for box in boxes]
+        rec_res, elapse = self.text_recognizer(img_crop_list)
+        cron_logger.debug("rec_res num  : {}, elapsed : {}".format(
+            len(rec_res), elapse))
+        return [text if score >= self.drop_score else "" for text, score in rec_res]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
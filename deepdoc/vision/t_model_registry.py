@@ -0,0 +1,63 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import os
+import sys
+from timeit import default_timer as timer
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+from deepdoc.parser import pdf_parser
+from deepdoc.vision import model_registry
+
+
+def new_parser(shared):
+    if not shared:
+        model_registry.clear()
+        pdf_parser._UPDOWN_CNT_MDL = None
+    st = timer()
+    parser = pdf_parser.HuParser()
+    return parser, timer() - st
+
+
+def main(args):
+    _, el = new_parser(True)
+    print("Startup: {:.2f}s".format(el))
+    print("{:>8} {:>14} {:>14}".format("models", "new parser(s)", "per task(s)"))
+    for shared in [False, True]:
+        tm, tm_task = 0, 0
+        for _ in range(args.tasks):
+            parser, el = new_parser(shared)
+            tm += el
+            if args.inputs:
+                st = timer()
+                parser(args.inputs)
+                el += timer() - st
+            tm_task += el
+        print("{:>8} {:>14.3f} {:>14.3f}".format("shared" if shared else "reloaded",
+                                                 tm / args.tasks, tm_task / args.tasks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Latency of creating a PDF parser per task, with the models shared or reloaded every time.")
+    parser.add_argument('--inputs', help="A PDF parsed by every task. Default: only create the parsers", default=None)
+    parser.add_argument('--tasks', help="Number of tasks. Default: 5", type=int, default=5)
+    args = parser.parse_args()
+    main(args)
@@ -17,6 +17,7 @@ import argparse
 import numpy as np
 import os
 import sys
+from timeit import default_timer as timer
 sys.path.insert(
     0,
     os.path.abspath(
@@ -26,9 +27,33 @@ sys.path.insert(
             '../../')))
 
 
+def benchmark(ocr, images):
+    print("{:>6} {:>6} {:>12} {:>12}".format("page", "boxes", "one-by-one", "batched"))
+    total = [0, 0]
+    for i, img in enumerate(images):
+        img = np.array(img)
+        boxes = [np.array(b, dtype=np.float32) for b, _ in ocr.detect(img)]
+        st = timer()
+        txt = [ocr.recognize(np.array(images[i]), b) for b in boxes]
+        el = timer() - st
+        st = timer()
+        txt_ = ocr.recognize_batch(img, boxes)
+        el_ = timer() - st
+        total[0] += el
+        total[1] += el_
+        print("{:>6} {:>6} {:>11.0f}ms {:>11.0f}ms".format(i, len(boxes), el * 1000, el_ * 1000))
+        if txt != txt_:
+            print("       {} of {} boxes read differently".format(len([1 for a, b in zip(txt, txt_) if a != b]), len(txt)))
+    print("{:>6} {:>6} {:>11.0f}ms {:>11.0f}ms".format("avg", "", total[0] * 1000 / max(len(images), 1),
+                                                      total[1] * 1000 / max(len(images), 1)))
+
+
 def main(args):
     ocr = OCR()
     images, outputs = init_in_out(args)
+    if args.benchmark:
+        benchmark(ocr, images)
+        return
 
     for i, img in enumerate(images):
         bxs = ocr(np.array(img))
@@ -51,5 +76,7 @@ if __name__ == "__main__":
                         required=True)
     parser.add_argument('--output_dir', help="Directory where to store the output images. Default: './ocr_outputs'",
                         default="./ocr_outputs")
+    parser.add_argument('--benchmark', help="Compare the per-page latency of recognizing the boxes one by one and in batches",
+                        action="store_true")
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,98 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+from rag.settings import EMBEDDING_CACHE as CONFIG
+from rag.utils.cache import LRUCache
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by (embedding model, md5 of the text), so the chunks which
+    are unchanged are not sent to the model again when a document is re-parsed.
+    A size bounded in-process LRU sits in front of Redis, which keeps the
+    vectors as float32 bytes. Both keep them for `expire` seconds, 0 leaving
+    Redis out and the in-process ones until they are evicted.
+    """
+
+    def __init__(self, local_size=10000, expire=7 * 24 * 3600, prefix="embd"):
+        self.local = LRUCache(local_size)
+        self.expire = expire
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, model, text):
+        return "{}:{}:{}".format(self.prefix, model, hashlib.md5(text.encode("utf-8")).hexdigest())
+
+    def local_get(self, key):
+        v = self.local.get(key)
+        if v is not None and 0 < self.expire < time.time() - v[0]:
+            self.local.pop(key)
+            return None
+        return v[1] if v is not None else None
+
+    def get(self, model, texts):
+        """
+        Returns the cached vector of every text, None for those not cached.
+        The vectors are copies the caller may modify.
+        """
+        keys = [self.key(model, t) for t in texts]
+        vects = [self.local_get(k) for k in keys]
+        missed = [i for i, v in enumerate(vects) if v is None]
+        if missed and self.expire > 0 and REDIS_CONN.is_alive():
+            for i, v in zip(missed, REDIS_CONN.mget([keys[i] for i in missed]) or []):
+                if v is None:
+                    continue
+                vects[i] = np.frombuffer(v, dtype=np.float32)
+                self.local.put(keys[i], (time.time(), vects[i]))
+        hits = len([v for v in vects if v is not None])
+        with self.lock:
+            self.hits += hits
+            self.misses += len(texts) - hits
+        return [None if v is None else np.array(v, copy=True) for v in vects]
+
+    def put(self, model, texts, vects):
+        mapping = {}
+        for t, v in zip(texts, vects):
+            k = self.key(model, t)
+            # A copy, so the caller modifying its vectors leaves the cache alone.
+            v = np.array(v, dtype=np.float32)
+            self.local.put(k, (time.time(), v))
+            mapping[k] = v.tobytes()
+        if mapping and self.expire > 0 and REDIS_CONN.is_alive():
+            REDIS_CONN.mset(mapping, self.expire)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.,
+                "local": self.local.stats()}
+
+
+EMBEDDING_CACHE = EmbeddingCache(int(CONFIG.get("local_size", 10000)),
+                                 int(CONFIG.get("expire", 7 * 24 * 3600)))
+# Query embeddings are kept apart, since some models embed queries
+# differently, and per tenant.
+QUERY_EMBEDDING_CACHE = EmbeddingCache(int(CONFIG.get("query_local_size", 1000)),
+                                       int(CONFIG.get("query_expire", 24 * 3600)),
+                                       prefix="embdq")
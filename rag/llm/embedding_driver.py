@@ -0,0 +1,159 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+import openai
+import requests
+import zhipuai
+
+from rag.settings import EMBEDDING_DRIVER as CONFIG, cron_logger
+
+
+# Failures to reach a provider, or to hear back from it in time.
+TRANSPORT_ERRORS = (ConnectionError, TimeoutError,
+                    openai.APIConnectionError, openai.APITimeoutError,
+                    requests.ConnectionError, requests.Timeout,
+                    httpx.TransportError, zhipuai.APITimeoutError)
+
+
+class EmbeddingRequestError(Exception):
+    def __init__(self, status_code, message=""):
+        super().__init__("[{}] {}".format(status_code, message))
+        self.status_code = status_code
+
+
+class RateLimiter:
+    """
+    Spaces the requests to a provider `1 / rate` seconds apart.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1. / rate
+        self.next = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next)
+            self.next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class EmbeddingDriver:
+    """
+    Sends the batches of a remote embedding model concurrently. At most
+    `concurrency` requests are in flight per process, the requests to every
+    provider are rate limited by `rate_limits` (requests a second, by factory
+    name), and throttled or failed requests are retried with exponential
+    backoff. The clients of the providers are blocking, so the requests run
+    on a thread pool.
+    """
+
+    def __init__(self, concurrency=8, max_retries=3, backoff=1., max_backoff=30., rate_limits=None):
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limits = rate_limits or {}
+        self.limiters = {}
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def limiter(self, provider):
+        rate = float(self.rate_limits.get(provider) or 0)
+        if rate <= 0:
+            return None
+        with self.lock:
+            if provider not in self.limiters:
+                self.limiters[provider] = RateLimiter(rate)
+            return self.limiters[provider]
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix="embedding")
+            return self.pool
+
+    @staticmethod
+    def retryable(e):
+        # Not a bad input or a malformed response, which would fail again.
+        if isinstance(e, TRANSPORT_ERRORS):
+            return True
+        status = getattr(e, "status_code", None)
+        return isinstance(status, int) and (status in (408, 409, 429) or status >= 500)
+
+    @staticmethod
+    def retry_after(e):
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    def call(self, provider, fn, *args):
+        limiter = self.limiter(provider)
+        for attempt in range(self.max_retries + 1):
+            if limiter:
+                limiter.acquire()
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt == self.max_retries or not self.retryable(e):
+                    raise
+                wait = self.retry_after(e)
+                if wait is None:
+                    wait = min(self.max_backoff, self.backoff * 2 ** attempt) * (.5 + random.random() / 2)
+                cron_logger.warning("Embedding request to {} failed, retry in {:.1f}s: {}".format(provider, wait, e))
+                time.sleep(wait)
+
+    def map(self, provider, fn, items):
+        """
+        Returns fn(item) of every item, in order.
+        """
+        if len(items) < 2 or self.concurrency < 2:
+            return [self.call(provider, fn, it) for it in items]
+        futures = [self.executor().submit(self.call, provider, fn, it) for it in items]
+        try:
+            return [f.result() for f in futures]
+        except Exception:
+            for f in futures:
+                f.cancel()
+            raise
+
+    def encode(self, provider, fn, texts, batch_size):
+        """
+        `fn` embeds a batch of texts and returns (embeddings, token count).
+        """
+        batch_size = max(1, batch_size)
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        arr, tks_num = [], 0
+        for embds, tks in self.map(provider, fn, batches):
+            arr.extend(embds)
+            tks_num += tks
+        return np.array(arr), tks_num
+
+
+EMBEDDING_DRIVER = EmbeddingDriver(int(CONFIG.get("concurrency", 8)),
+                                   int(CONFIG.get("max_retries", 3)),
+                                   float(CONFIG.get("backoff", 1)),
+                                   rate_limits=CONFIG.get("rate_limits") or {})
@@ -28,6 +28,7 @@ import torch
 import numpy as np
 
 from api.utils.file_utils import get_project_base_directory
+from rag.llm.embedding_driver import EMBEDDING_DRIVER, EmbeddingRequestError
 from rag.utils import num_tokens_from_string
 
 
@@ -47,6 +48,9 @@ except Exception as e:
 
 
 class Base(ABC):
+    # Sends the requests of the remote models.
+    driver = EMBEDDING_DRIVER
+
     def __init__(self, key, model_name):
         pass
 
@@ -107,98 +111,101 @@ class HuEmbedding(Base):
 
 
 class OpenAIEmbed(Base):
+    provider = "OpenAI"
+
     def __init__(self, key, model_name="text-embedding-ada-002",
                  base_url="https://api.openai.com/v1"):
         if not base_url:
             base_url = "https://api.openai.com/v1"
-        self.client = OpenAI(api_key=key, base_url=base_url)
+        # Retries are left to the driver.
+        self.client = OpenAI(api_key=key, base_url=base_url, max_retries=0)
         self.model_name = model_name
+        self.base_url = base_url
 
-    def encode(self, texts: list, batch_size=32):
+    def embed(self, texts):
         res = self.client.embeddings.create(input=texts,
                                             model=self.model_name)
-        return np.array([d.embedding for d in res.data]
-                        ), res.usage.total_tokens
+        return [d.embedding for d in res.data], res.usage.total_tokens
+
+    def encode(self, texts: list, batch_size=32):
+        return self.driver.encode(self.provider, self.embed, texts, batch_size)
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(input=[text],
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        embds, tks = self.driver.call(self.provider, self.embed, [text])
+        return np.array(embds[0]), tks
 
 
 class QWenEmbed(Base):
+    provider = "Tongyi-Qianwen"
+
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         dashscope.api_key = key
         self.model_name = model_name
 
+    def embed(self, texts, text_type="document"):
+        resp = dashscope.TextEmbedding.call(
+            model=self.model_name,
+            input=texts,
+            text_type=text_type
+        )
+        if resp.status_code != 200:
+            raise EmbeddingRequestError(resp.status_code, resp.message)
+        embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
+        for e in resp["output"]["embeddings"]:
+            embds[e["text_index"]] = e["embedding"]
+        return embds, resp["usage"]["total_tokens"]
+
     def encode(self, texts: list, batch_size=10):
-        import dashscope
-        res = []
-        token_count = 0
         texts = [txt[:2048] for txt in texts]
-        for i in range(0, len(texts), batch_size):
-            resp = dashscope.TextEmbedding.call(
-                model=self.model_name,
-                input=texts[i:i + batch_size],
-                text_type="document"
-            )
-            embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
-            for e in resp["output"]["embeddings"]:
-                embds[e["text_index"]] = e["embedding"]
-            res.extend(embds)
-            token_count += resp["usage"]["total_tokens"]
-        return np.array(res), token_count
+        # DashScope takes at most 10 texts a request.
+        return self.driver.encode(self.provider, self.embed, texts, min(batch_size, 10))
 
     def encode_queries(self, text):
-        resp = dashscope.TextEmbedding.call(
-            model=self.model_name,
-            input=text[:2048],
-            text_type="query"
-        )
-        return np.array(resp["output"]["embeddings"][0]
-                        ["embedding"]), resp["usage"]["total_tokens"]
+        embds, tks = self.driver.call(self.provider, self.embed, [text[:2048]], "query")
+        return np.array(embds[0]), tks
 
 
 class ZhipuEmbed(Base):
+    provider = "ZHIPU-AI"
+
     def __init__(self, key, model_name="embedding-2", **kwargs):
         self.client = ZhipuAI(api_key=key)
         self.model_name = model_name
 
+    def embed(self, texts):
+        # One text a request.
+        res = self.client.embeddings.create(input=texts[0],
+                                            model=self.model_name)
+        return [res.data[0].embedding], res.usage.total_tokens
+
     def encode(self, texts: list, batch_size=32):
-        arr = []
-        tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings.create(input=txt,
-                                                model=self.model_name)
-            arr.append(res.data[0].embedding)
-            tks_num += res.usage.total_tokens
-        return np.array(arr), tks_num
+        return self.driver.encode(self.provider, self.embed, texts, 1)
 
     def encode_queries(self, text):
-        res = self.client.embeddings.create(input=text,
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        embds, tks = self.driver.call(self.provider, self.embed, [text])
+        return np.array(embds[0]), tks
 
 
 class OllamaEmbed(Base):
+    provider = "Ollama"
+
     def __init__(self, key, model_name, **kwargs):
         self.client = Client(host=kwargs["base_url"])
         self.model_name = model_name
+        self.base_url = kwargs["base_url"]
+
+    def embed(self, texts):
+        # One text a request.
+        res = self.client.embeddings(prompt=texts[0],
+                                     model=self.model_name)
+        return [res["embedding"]], 128
 
     def encode(self, texts: list, batch_size=32):
-        arr = []
-        tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings(prompt=txt,
-                                         model=self.model_name)
-            arr.append(res["embedding"])
-            tks_num += 128
-        return np.array(arr), tks_num
+        return self.driver.encode(self.provider, self.embed, texts, 1)
 
     def encode_queries(self, text):
-        res = self.client.embeddings(prompt=text,
-                                     model=self.model_name)
-        return np.array(res["embedding"]), 128
+        embds, tks = self.driver.call(self.provider, self.embed, [text])
+        return np.array(embds[0]), tks
 
 
 class FastEmbed(Base):
@@ -232,21 +239,13 @@ class FastEmbed(Base):
         return np.array(embedding), len(encoding.ids)
 
 
-class XinferenceEmbed(Base):
+class XinferenceEmbed(OpenAIEmbed):
+    provider = "Xinference"
+
     def __init__(self, key, model_name="", base_url=""):
-        self.client = OpenAI(api_key="xxx", base_url=base_url)
+        self.client = OpenAI(api_key="xxx", base_url=base_url, max_retries=0)
         self.model_name = model_name
-
-    def encode(self, texts: list, batch_size=32):
-        res = self.client.embeddings.create(input=texts,
-                                            model=self.model_name)
-        return np.array([d.embedding for d in res.data]
-                        ), res.usage.total_tokens
-
-    def encode_queries(self, text):
-        res = self.client.embeddings.create(input=[text],
-                                            model=self.model_name)
-        return np.array(res.data[0].embedding), res.usage.total_tokens
+        self.base_url = base_url
 
 
 class QAnythingEmbed(Base):
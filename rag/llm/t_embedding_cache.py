@@ -0,0 +1,74 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+
+import argparse
+import copy
+from timeit import default_timer as timer
+
+from api.db import LLMType
+from api.db.services.llm_service import LLMBundle
+from api.utils.file_utils import traversal_files
+from rag.llm.embedding_cache import EMBEDDING_CACHE
+from rag.svr.task_executor import FACTORY, embedding
+
+
+def dummy(prog=None, msg=""):
+    pass
+
+
+def main(args):
+    files = traversal_files(args.inputs) if os.path.isdir(args.inputs) else [args.inputs]
+    cks = []
+    for fnm in files:
+        with open(fnm, "rb") as f:
+            cks.extend(FACTORY[args.parser_id].chunk(os.path.basename(fnm), binary=f.read(), callback=dummy))
+    print("Chunks: {}".format(len(cks)))
+
+    mdl = LLMBundle(args.tenant_id, LLMType.EMBEDDING, llm_name=args.embd_id)
+    if not args.redis:
+        EMBEDDING_CACHE.expire = 0
+    EMBEDDING_CACHE.local.clear()
+    for run in ["cold", "warm"]:
+        if run == "warm" and args.redis:
+            # make the warm run read from Redis
+            EMBEDDING_CACHE.local.clear()
+        st = timer()
+        tk_count = embedding(copy.deepcopy(cks), mdl)
+        print("{}: {:.2f}s, tokens: {}, {}".format(run, timer() - st, tk_count, EMBEDDING_CACHE.stats()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Embedding time of re-indexing documents with a cold and a warm embedding cache.")
+    parser.add_argument('--inputs', help="Directory of documents, or a single document", required=True)
+    parser.add_argument('--tenant_id', help="Tenant whose embedding model is used", required=True)
+    parser.add_argument('--embd_id', help="Embedding model. Default: the tenant's default", default=None)
+    parser.add_argument('--parser_id', help="Chunk method. Default: 'naive'", default="naive")
+    parser.add_argument('--redis', help="Measure the Redis cache instead of the in-memory one. "
+                                        "Vectors cached by earlier runs make the cold run warm.",
+                        action="store_true")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,103 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer as timer
+
+from rag.llm.embedding_driver import EmbeddingDriver
+from rag.llm.embedding_model import OpenAIEmbed
+
+
+class FakeEmbeddings(BaseHTTPRequestHandler):
+    """
+    An OpenAI compatible /embeddings endpoint which answers after `latency`
+    seconds and throttles every `fail_every`th request with a 429.
+    """
+    latency = 0.
+    fail_every = 0
+    counter = itertools.count(1)
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        n = next(self.counter)
+        time.sleep(self.latency)
+        if self.fail_every and n % self.fail_every == 0:
+            self.send_response(429)
+            self.send_header("Retry-After", "0.1")
+            body = json.dumps({"error": {"message": "Too many requests"}}).encode("utf-8")
+        else:
+            self.send_response(200)
+            data = [{"object": "embedding", "index": i, "embedding": [float(len(t)), float(i)]}
+                    for i, t in enumerate(req["input"])]
+            body = json.dumps({"object": "list", "data": data, "model": req["model"],
+                               "usage": {"prompt_tokens": len(data), "total_tokens": len(data)}}).encode("utf-8")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(args):
+    FakeEmbeddings.latency = args.latency
+    FakeEmbeddings.fail_every = args.fail_every
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmbeddings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The real provider path: the OpenAI client, without retries of its own.
+    mdl = OpenAIEmbed("xxx", "fake", base_url="http://127.0.0.1:{}/v1".format(server.server_port))
+
+    texts = ["x" * (i % 97 + 1) for i in range(args.texts)]
+    print("{:>12} {:>10} {:>10}".format("concurrency", "seconds", "texts/s"))
+    for c in [int(c) for c in args.concurrency.split(",")]:
+        mdl.driver = EmbeddingDriver(c, backoff=0.1, rate_limits={mdl.provider: args.rate_limit})
+        st = timer()
+        vects, tks = mdl.encode(texts, args.batch_size)
+        el = timer() - st
+        assert tks == len(texts) and [v[0] for v in vects] == [len(t) for t in texts]
+        print("{:>12} {:>10.2f} {:>10.1f}".format(c, el, len(texts) / el))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Embedding throughput versus the number of concurrent requests, against a local fake server.")
+    parser.add_argument('--texts', help="Texts to embed. Default: 2000", type=int, default=2000)
+    parser.add_argument('--batch_size', help="Texts a request. Default: 10", type=int, default=10)
+    parser.add_argument('--latency', help="Seconds the server takes per request. Default: 0.05",
+                        type=float, default=0.05)
+    parser.add_argument('--fail_every', help="Throttle every Nth request with a 429, 0 never. Default: 25",
+                        type=int, default=25)
+    parser.add_argument('--rate_limit', help="Requests a second, 0 unlimited. Default: 0", type=float, default=0)
+    parser.add_argument('--concurrency', help="Comma separated concurrency. Default: '1,4,8,16'",
+                        default="1,4,8,16")
+    args = parser.parse_args()
+    main(args)
@@ -7,14 +7,35 @@ import os
 import re
 import string
 import sys
-from hanziconv import HanziConv
+from hanziconv.charmap import traditional_charmap, simplified_charmap
 from huggingface_hub import snapshot_download
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
+from rag.settings import HUQIE
+from rag.utils.cache import LRUCache
+
+
+def _q2b_table():
+    # full-width forms and the ideographic space, as _strQ2B converted them char by char
+    tbl = {c: c - 0xfee0 for c in range(0xff00, 0xff5f)}
+    tbl[0x3000] = 0x0020
+    return tbl
+
+
+def _t2s_table():
+    # HanziConv.toSimplified maps a char by its first position in the charmap
+    tbl = {}
+    for t, s in zip(traditional_charmap, simplified_charmap):
+        if ord(t) not in tbl and t != s:
+            tbl[ord(t)] = s
+    return tbl
 
 
 class Huqie:
+    Q2B = _q2b_table()
+    T2S = _t2s_table()
+
     def key_(self, line):
         return str(line.lower().encode("utf-8"))[2:-1]
 
@@ -51,6 +72,14 @@ class Huqie:
         self.lemmatizer = WordNetLemmatizer()
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-z\.-]+|[0-9,\.-]+)"
+
+        # Recent results, keyed on the normalized text. They are dropped
+        # whenever the dictionary changes.
+        self.MAX_CACHED_LEN = int(HUQIE.get("max_length", 1024))
+        self.qie_cache_ = LRUCache(int(HUQIE.get("cache_size", 10000)))
+        self.qieqie_cache_ = LRUCache(int(HUQIE.get("cache_size", 10000)))
+        self.term_cache_ = LRUCache(int(HUQIE.get("term_cache_size", 100000)))
+        self.ENGINE = HUQIE.get("engine", "dp")
         try:
             self.trie_ = datrie.Trie.load(self.DIR_ + ".txt.trie")
             return
@@ -61,6 +90,7 @@ class Huqie:
         self.loadDict_(self.DIR_ + ".txt")
 
     def loadUserDict(self, fnm):
+        self.clear_cache()
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -69,25 +99,28 @@ class Huqie:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        self.clear_cache()
         self.loadDict_(fnm)
 
+    def clear_cache(self):
+        for c in [self.qie_cache_, self.qieqie_cache_, self.term_cache_]:
+            c.clear()
+
+    def cache_stats(self):
+        return {"qie": self.qie_cache_.stats(),
+                "qieqie": self.qieqie_cache_.stats(),
+                "term": self.term_cache_.stats()}
+
     def _strQ2B(self, ustring):
         """把字符串全角转半角"""
-        rstring = ""
-        for uchar in ustring:
-            inside_code = ord(uchar)
-            if inside_code == 0x3000:
-                inside_code = 0x0020
-            else:
-                inside_code -= 0xfee0
-            if inside_code < 0x0020 or inside_code > 0x7e:  # 转完之后不是半角字符返回原来的字符
-                rstring += uchar
-            else:
-                rstring += chr(inside_code)
-        return rstring
+        if ustring.isascii():
+            return ustring
+        return ustring.translate(self.Q2B)
 
     def _tradi2simp(self, line):
-        return HanziConv.toSimplified(line)
+        if line.isascii():
+            return line
+        return line.translate(self.T2S)
 
     def dfs_(self, chars, s, preTks, tkslist):
         MAX_L = 10
@@ -138,17 +171,23 @@ class Huqie:
 
         return self.dfs_(chars, s + 1, preTks, tkslist)
 
-    def freq(self, tk):
+    def term_(self, tk):
+        v = self.term_cache_.get(tk)
+        if v is not None:
+            return v
         k = self.key_(tk)
         if k not in self.trie_:
-            return 0
-        return int(math.exp(self.trie_[k][0]) * self.DENOMINATOR + 0.5)
+            v = (0, "")
+        else:
+            v = (int(math.exp(self.trie_[k][0]) * self.DENOMINATOR + 0.5), self.trie_[k][1])
+        self.term_cache_.put(tk, v)
+        return v
+
+    def freq(self, tk):
+        return self.term_(tk)[0]
 
     def tag(self, tk):
-        k = self.key_(tk)
-        if k not in self.trie_:
-            return ""
-        return self.trie_[k][1]
+        return self.term_(tk)[1]
 
     def score_(self, tfts):
         B = 30
@@ -241,9 +280,138 @@ class Huqie:
 
         return self.score_(res[::-1])
 
+    def keys_(self, line):
+        """
+        The trie key of every char of line, so that the key of a substring
+        is the concatenation of them and the trie can be walked char by char.
+        None if it can't, i.e. the engine is 'dfs', line isn't lower case or
+        it holds both kinds of quotes, which its repr escapes as a whole.
+        """
+        if self.ENGINE != "dp" or line != line.lower() or ("'" in line and '"' in line):
+            return None
+        return [self.key_(c) for c in line]
+
+    def words_(self, line, keys):
+        """
+        Walks the trie once from every position of line. Returns the words
+        starting there as (end, (freq, tag)) by increasing length, and whether
+        the first one and two chars from there are prefixes of any word.
+        """
+        words, pre1, pre2 = [], [], []
+        state = datrie.State(self.trie_)
+        for s in range(len(line)):
+            state.rewind()
+            ws, depth = [], 0
+            for e in range(s, len(line)):
+                if not state.walk(keys[e]):
+                    break
+                depth += 1
+                if state.is_terminal():
+                    ws.append((e + 1, state.data()))
+            words.append(ws)
+            pre1.append(depth > 0)
+            pre2.append(depth > 1)
+        return words, pre1, pre2
+
+    def walkForward_(self, line, words):
+        """maxForward_ on the words found by words_."""
+        res, s = [], 0
+        while s < len(line):
+            e, v = words[s][-1] if words[s] else (s + 1, (0, ''))
+            res.append((line[s:e], v))
+            s = e
+        return self.score_(res)
+
+    def walkBackward_(self, line, keys, words):
+        """maxBackward_ on the words found by words_, walking the reversed keys."""
+        ends = [dict(ws) for ws in words]
+        res, e = [], len(line)
+        state = datrie.State(self.trie_)
+        while e > 0:
+            state.rewind()
+            s = e - 1
+            if state.walk("DD"):
+                while s > 0 and state.walk(keys[s]):
+                    s -= 1
+            while s + 1 < e and e not in ends[s]:
+                s += 1
+            res.append((line[s:e], ends[s].get(e, (0, ''))))
+            e = s
+        return self.score_(res[::-1])
+
+    def best_(self, chars, topn=1):
+        """
+        The topn segmentations of chars as sortTks_ ranks the ones dfs_
+        enumerates, and how many dfs_ enumerates.
+
+        Instead of enumerating them, a forward dynamic programming keeps, for
+        every position, number of trailing single-char tokens (dfs_ prunes on
+        it, up to 3) and number of tokens, the paths of the topn highest
+        L + F sums, since score_ only grows with it for a given number of
+        tokens. Paths are tuples of token ends, whose order is the order in
+        which dfs_ finds them, so ties break as in the stable sort.
+        """
+        keys = self.keys_(chars)
+        if keys is None:
+            tkslist = []
+            self.dfs_(chars, 0, [], tkslist)
+            return [tks for tks, _ in self.sortTks_(tkslist)[:topn]], len(tkslist)
+
+        N = len(chars)
+        words, pre1, pre2 = self.words_(chars, keys)
+        # paths[pos][trail][n][(L, F)] are the first topn paths reaching there
+        paths = [{} for _ in range(N + 1)]
+        counts = [{} for _ in range(N + 1)]
+        paths[0][0] = {0: {(0, 0): [()]}}
+        counts[0][0] = 1
+        for s in range(N):
+            for trail, groups in paths[s].items():
+                S = s + 1
+                if s + 2 <= N and pre1[s] and not pre2[s]:
+                    S = s + 2
+                if trail > 2 and pre2[s - 1]:
+                    S = s + 2
+                edges = [(e, v) for e, v in words[s] if e >= S]
+                if not edges:
+                    edges = [(s + 1, words[s][0][1] if words[s] and words[s][0][0] == s + 1 else (-12, ''))]
+
+                for e, v in edges:
+                    t = min(trail + 1, 3) if e == s + 1 else 0
+                    counts[e][t] = counts[e].get(t, 0) + counts[s][trail]
+                    target = paths[e].setdefault(t, {})
+                    for n, grp in groups.items():
+                        tg = target.setdefault(n + 1, {})
+                        for (L, F), prefixes in grp.items():
+                            k = (L + (1 if e - s > 1 else 0), F + v[0])
+                            tg[k] = sorted(tg.get(k, []) + [p + (e,) for p in prefixes])[:topn]
+
+            for groups in paths[s + 1].values():
+                for n, grp in groups.items():
+                    top = sorted(set([L + F for L, F in grp.keys()]), reverse=True)[:topn]
+                    groups[n] = {k: v for k, v in grp.items() if k[0] + k[1] >= top[-1]}
+
+        res = []
+        for groups in paths[N].values():
+            for n, grp in groups.items():
+                for (L, F), prefixes in grp.items():
+                    # the same arithmetic as score_
+                    sc = 30 / n + L / n + F / n
+                    res.extend([(-sc, p) for p in prefixes])
+        res = sorted(res)[:topn]
+        return [[chars[a:b] for a, b in zip((0,) + p[:-1], p)] for _, p in res], sum(counts[N].values())
+
     def qie(self, line):
         line = self._strQ2B(line).lower()
         line = self._tradi2simp(line)
+        if len(line) > self.MAX_CACHED_LEN:
+            return self.qie_(line)
+        res = self.qie_cache_.get(line)
+        if res is None:
+            res = self.qie_(line)
+            self.qie_cache_.put(line, res)
+        return res
+
+    def qie_(self, line):
         zh_num = len([1 for c in line if is_chinese(c)])
         if zh_num < len(line) * 0.2:
             return " ".join([self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(line)])
@@ -258,8 +426,14 @@ class Huqie:
             # print(L)
 
             # use maxforward for the first time
-            tks, s = self.maxForward_(L)
-            tks1, s1 = self.maxBackward_(L)
+            keys = self.keys_(L)
+            if keys is None:
+                tks, s = self.maxForward_(L)
+                tks1, s1 = self.maxBackward_(L)
+            else:
+                words, _, _ = self.words_(L, keys)
+                tks, s = self.walkForward_(L, words)
+                tks1, s1 = self.walkBackward_(L, keys, words)
             if self.DEBUG:
                 print("[FW]", tks, s)
                 print("[BW]", tks1, s1)
@@ -287,9 +461,8 @@ class Huqie:
                 while e < len(tks) and e - s < 5 and diff[e] == 1:
                     e += 1
 
-                tkslist = []
-                self.dfs_("".join(tks[s:e + 1]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                best, _ = self.best_("".join(tks[s:e + 1]))
+                res.append(" ".join(best[0]))
 
                 i = e + 1
 
@@ -299,6 +472,15 @@ class Huqie:
         return self.merge_(res)
 
     def qieqie(self, tks):
+        if len(tks) > self.MAX_CACHED_LEN:
+            return self.qieqie_(tks)
+        res = self.qieqie_cache_.get(tks)
+        if res is None:
+            res = self.qieqie_(tks)
+            self.qieqie_cache_.put(tks, res)
+        return res
+
+    def qieqie_(self, tks):
         tks = tks.split(" ")
         zh_num = len([1 for c in tks if c and is_chinese(c[0])])
         if zh_num < len(tks) * 0.2:
@@ -312,15 +494,14 @@ class Huqie:
             if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
                 res.append(tk)
                 continue
-            tkslist = []
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
                 res.append(tk)
                 continue
-            stk = self.sortTks_(tkslist)[1][0]
+            best, cnt = self.best_(tk, 2)
+            if cnt < 2:
+                res.append(tk)
+                continue
+            stk = best[1]
             if len(stk) == len(tk):
                 stk = tk
             else:
@@ -380,6 +561,7 @@ loadUserDict = hq.loadUserDict
 addUserDict = hq.addUserDict
 tradi2simp = hq._tradi2simp
 strQ2B = hq._strQ2B
+cache_stats = hq.cache_stats
 
 if __name__ == '__main__':
     huqie = Huqie(debug=True)
@@ -5,6 +5,8 @@ import math
 import re
 import logging
 import copy
+import numpy as np
+from scipy.sparse import csr_matrix
 from elasticsearch_dsl import Q
 
 from rag.nlp import huqie, term_weight, synonym
@@ -136,23 +138,42 @@ class EsQueryer:
         from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
         import numpy as np
         sims = CosineSimilarity([avec], bvecs)
-
-        def toDict(tks):
-            d = {}
-            if isinstance(tks, str):
-                tks = tks.split(" ")
-            for t, c in self.tw.weights(tks):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        tksim = [self.similarity(atks, btks) for btks in btkss]
+        tksim = self.token_similarity(atks, btkss)
         return np.array(sims[0]) * vtweight + \
             np.array(tksim) * tkweight, tksim, sims[0]
 
+    def token_similarity(self, atks, btkss):
+        """
+        similarity() of the query tokens against every candidate at once.
+        Only the term set of a candidate matters, so a candidate may also be
+        given as a precomputed set of terms (see term_weight.Dealer.term_set).
+        """
+        if isinstance(atks, str):
+            atks = atks.split(" ")
+        qtwt = {}
+        for t, c in self.tw.weights(atks):
+            qtwt[t] = qtwt.get(t, 0) + c
+        if not btkss:
+            return []
+        btkss = [tks if isinstance(tks, (set, frozenset)) else self.tw.term_set(tks)
+                 for tks in btkss]
+
+        qidx = {t: i for i, t in enumerate(qtwt.keys())}
+        rows, cols = [], []
+        for r, terms in enumerate(btkss):
+            for t in terms:
+                if t in qidx:
+                    rows.append(r)
+                    cols.append(qidx[t])
+        w = np.array(list(qtwt.values()), dtype=float)
+        s = np.full(len(btkss), 1e-9)
+        if rows:
+            s += csr_matrix((np.ones(len(rows)), (rows, cols)),
+                            shape=(len(btkss), len(qidx))).dot(w)
+        q = 1e-9 + np.sum(w)
+        n = np.maximum(np.array([len(terms) for terms in btkss]), max(len(qidx), 1))
+        return list(s / q / np.maximum(1, np.sqrt(np.log10(n))))
+
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
             dtwt = {t: w for t, w in self.tw.weights(self.tw.split(dtwt))}
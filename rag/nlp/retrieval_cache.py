@@ -0,0 +1,132 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+
+from rag.nlp import huqie
+from rag.settings import RETRIEVAL_CACHE as CONFIG
+from rag.utils.cache import LRUCache
+from rag.utils.redis_conn import REDIS_CONN
+
+
+class RetrievalCache:
+    """
+    Retrieval results keyed by the question and every setting of the retrieval,
+    together with the versions of the tenant and the knowledgebases searched.
+    Changing the content of a knowledgebase bumps its version, so the results
+    computed before are never looked up again. The versions are kept in Redis,
+    so all the processes see the bumps and may share the results, and in the
+    process, so results are still cached in memory while Redis is down. Then
+    the bumps made by other processes aren't seen, and a result may be stale
+    for up to `expire` seconds.
+    """
+    VERSION = "retrieval:version:{}"
+    # The keys made from the versions of the process, which stay off Redis.
+    LOCAL = "retrieval:local:"
+
+    def __init__(self, local_size=1000, expire=600, shared=True):
+        self.local = LRUCache(local_size)
+        self.expire = expire
+        self.shared = shared
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(question):
+        return re.sub(r"[ \t\r\n]+", " ", huqie.strQ2B(question.lower())).strip()
+
+    @staticmethod
+    def model_name(embd_mdl):
+        if hasattr(embd_mdl, "cache_key"):
+            return embd_mdl.cache_key()
+        return "{}/{}".format(embd_mdl.__class__.__name__, getattr(embd_mdl, "model_name", ""))
+
+    def key(self, tenant_id, kb_ids, question, embd_mdl, **settings):
+        """
+        None if the results can't be cached.
+        """
+        if self.expire <= 0:
+            return
+        ids = [tenant_id] + sorted(kb_ids)
+        prefix = "retrieval:"
+        versions = REDIS_CONN.mget([self.VERSION.format(i) for i in ids]) if REDIS_CONN.is_alive() else None
+        if versions is not None:
+            versions = [v.decode("utf-8") if isinstance(v, bytes) else "0" for v in versions]
+        else:
+            prefix = self.LOCAL
+            with self.lock:
+                versions = [str(self.versions.get(i, 0)) for i in ids]
+        k = json.dumps([ids, versions, self.normalize(question), self.model_name(embd_mdl),
+                        sorted(settings.items(), key=lambda x: x[0])], ensure_ascii=False, default=str)
+        return "{}{}:{}".format(prefix, tenant_id, hashlib.md5(k.encode("utf-8")).hexdigest())
+
+    def shared_key(self, key):
+        return self.shared and not key.startswith(self.LOCAL) and REDIS_CONN.is_alive()
+
+    def get(self, key):
+        res = self.local.get(key)
+        if res is not None and time.time() - res[0] > self.expire:
+            self.local.pop(key)
+            res = None
+        if res is not None:
+            res = res[1]
+        elif self.shared_key(key):
+            v = REDIS_CONN.get(key)
+            if v:
+                res = json.loads(v)
+                self.local.put(key, (time.time(), res))
+        with self.lock:
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return copy.deepcopy(res)
+
+    def put(self, key, res):
+        self.local.put(key, (time.time(), copy.deepcopy(res)))
+        if self.shared_key(key):
+            REDIS_CONN.set(key, json.dumps(res, ensure_ascii=False, default=float), self.expire)
+
+    def invalidate(self, kb_ids=None, tenant_id=None):
+        """
+        Called whenever chunks of the knowledgebases, or of any knowledgebase
+        of the tenant, are added, removed, edited or switched.
+        """
+        ids = (kb_ids or []) + ([tenant_id] if tenant_id else [])
+        with self.lock:
+            for i in ids:
+                self.versions[i] = self.versions.get(i, 0) + 1
+        if not REDIS_CONN.is_alive():
+            return
+        for i in ids:
+            REDIS_CONN.incr(self.VERSION.format(i))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.,
+                "local": self.local.stats()}
+
+
+RETRIEVAL_CACHE = RetrievalCache(int(CONFIG.get("local_size", 1000)),
+                                 int(CONFIG.get("expire", 600)),
+                                 bool(CONFIG.get("shared", True)))
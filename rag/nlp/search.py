@@ -10,6 +10,7 @@ from dataclasses import dataclass
 from rag.settings import es_logger
 from rag.utils import rmSpace
 from rag.nlp import huqie, query
+from rag.nlp.retrieval_cache import RETRIEVAL_CACHE
 import numpy as np
 
 
@@ -17,6 +18,17 @@ def index_name(uid): return f"ragflow_{uid}"
 
 
 class Dealer:
+    # Cosine similarity between the query vector and the chunk vector,
+    # computed by ES so the vectors don't have to be shipped back.
+    VECTOR_SIMILARITY_SCRIPT = """
+        if (doc[params.field].size() == 0) { return 0; }
+        float[] v = doc[params.field].vectorValue;
+        double dot = 0;
+        for (int i = 0; i < v.length; i++) { dot += v[i] * params.query_vector[i]; }
+        double norm = doc[params.field].magnitude * params.query_norm;
+        return norm == 0 ? 0 : dot / norm;
+    """
+
     def __init__(self, es):
         self.qryr = query.EsQueryer(es)
         self.qryr.flds = [
@@ -27,6 +39,9 @@ class Dealer:
             "content_ltks^2",
             "content_sm_ltks"]
         self.es = es
+        # Falls back to reranking with the vectors in _source
+        # if the ES cluster fails to run the similarity script.
+        self.vector_in_source = False
 
     @dataclass
     class SearchResult:
@@ -38,6 +53,8 @@ class Dealer:
         aggregation: Union[List, Dict, None] = None
         keywords: Optional[List[str]] = None
         group_docs: List[List] = None
+        vector_similarity: Optional[Dict] = None
+        fused_score: Optional[Dict] = None
 
     def _vector(self, txt, emb_mdl, sim=0.8, topk=10):
         qv, c = emb_mdl.encode_queries(txt)
@@ -49,9 +66,8 @@ class Dealer:
             "query_vector": [float(v) for v in qv]
         }
 
-    def search(self, req, idxnm, emb_mdl=None):
-        qst = req.get("question", "")
-        bqry, keywords = self.qryr.question(qst)
+    @staticmethod
+    def _add_filters(bqry, req):
         if req.get("kb_ids"):
             bqry.filter.append(Q("terms", kb_id=req["kb_ids"]))
         if req.get("doc_ids"):
@@ -62,6 +78,12 @@ class Dealer:
             else:
                 bqry.filter.append(
                     Q("bool", must_not=Q("range", available_int={"lt": 1})))
+        return bqry
+
+    def search(self, req, idxnm, emb_mdl=None):
+        qst = req.get("question", "")
+        bqry, keywords = self.qryr.question(qst)
+        bqry = self._add_filters(bqry, req)
         bqry.boost = 0.05
 
         s = Search()
@@ -69,8 +91,9 @@ class Dealer:
         ps = int(req.get("size", 1000))
         topk = int(req.get("topk", 1024))
         src = req.get("fields", ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd",
-                                 "image_id", "doc_id", "q_512_vec", "q_768_vec", "position_int",
-                                 "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight"])
+                                 "image_id", "doc_id", "q_384_vec", "q_512_vec", "q_768_vec", "position_int",
+                                 "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight",
+                                 "rank_terms_with_weight"])
 
         s = s.query(bqry)[pg * ps:(pg + 1) * ps]
         s = s.highlight("content_ltks")
@@ -112,18 +135,41 @@ class Dealer:
             if "highlight" in s:
                 del s["highlight"]
             q_vec = s["knn"]["query_vector"]
-        es_logger.info("【Q】: {}".format(json.dumps(s)))
-        res = self.es.search(deepcopy(s), idxnm=idxnm, timeout="600s", src=src)
-        es_logger.info("TOTAL: {}".format(self.es.getTotal(res)))
-        if self.es.getTotal(res) == 0 and "knn" in s:
-            bqry, _ = self.qryr.question(qst, min_match="10%")
-            if req.get("kb_ids"):
-                bqry.filter.append(Q("terms", kb_id=req["kb_ids"]))
-            s["query"] = bqry.to_dict()
-            s["knn"]["filter"] = bqry.to_dict()
-            s["knn"]["similarity"] = 0.17
-            res = self.es.search(s, idxnm=idxnm, timeout="600s", src=src)
-            es_logger.info("【Q】: {}".format(json.dumps(s)))
+            if not self.vector_in_source:
+                src = [f for f in src if not re.match(r"q_[0-9]+_vec$", f)]
+                s["script_fields"] = {"vector_similarity": {"script": {
+                    "source": self.VECTOR_SIMILARITY_SCRIPT,
+                    "params": {"field": s["knn"]["field"], "query_vector": q_vec,
+                               "query_norm": float(np.linalg.norm(q_vec))}}}}
+        qs = [s]
+        fs = None
+        if "knn" in s:
+            # The looser query used when nothing matches. It has no kNN of its
+            # own: its vector hits would be filtered by the query anyway, so
+            # they'd only reorder its matches. With es.eager_fallback it is
+            # sent along in the same round trip, which costs a query on every
+            # search to save a round trip on the few finding nothing.
+            fbqry, _ = self.qryr.question(qst, min_match="10%")
+            fbqry = self._add_filters(fbqry, req)
+            fs = deepcopy({k: v for k, v in s.items() if k != "knn"})
+            fs["query"] = fbqry.to_dict()
+            if self.es.eager_fallback:
+                qs.append(fs)
+        es_logger.info("【Q】: {}".format(json.dumps(qs)))
+        try:
+            res = self.es.msearch(deepcopy(qs), idxnm=idxnm, src=src, timeout=req.get("timeout"))
+        except Exception as e:
+            # Without the vectors in _source there is nothing to fall back to.
+            if "script_fields" not in s or not self.es.vector_in_source or not self._script_failed(e):
+                raise e
+            es_logger.error("Vector similarity script failed, fetch vectors instead: {}".format(str(e)))
+            self.vector_in_source = True
+            return self.search(req, idxnm, emb_mdl)
+        es_logger.info("TOTAL: {}".format([self.es.getTotal(r) for r in res]))
+        if fs is not None and self.es.getTotal(res[0]) == 0:
+            res = res[1:] or self.es.msearch([fs], idxnm=idxnm, src=src, timeout=req.get("timeout"))
+            es_logger.info("FALLBACK TOTAL: {}".format(self.es.getTotal(res[0])))
+        res = res[0]
 
         kwds = set([])
         for k in keywords:
@@ -144,9 +190,97 @@ class Dealer:
             aggregation=aggs,
             highlight=self.getHighlight(res),
             field=self.getFields(res, src),
-            keywords=list(kwds)
+            keywords=list(kwds),
+            vector_similarity=self.getScriptField(res, "vector_similarity") if "script_fields" in s else None
         )
 
+    @staticmethod
+    def _script_failed(e):
+        # A 400 caused by the script, e.g. painless disabled or not compiling,
+        # rather than a timeout or a node being down.
+        if getattr(e, "status_code", None) != 400:
+            return False
+        return "script_exception" in json.dumps([str(e), getattr(e, "error", None), getattr(e, "body", None)],
+                                                default=str)
+
+    @staticmethod
+    def rrf(rankings, k=60):
+        """
+        Reciprocal rank fusion of rankings of ids, best first.
+        Returns the ids and their fused scores, best first.
+        """
+        ids = [i for r in rankings for i in r]
+        if not ids:
+            return [], np.array([])
+        ranks = np.concatenate([np.arange(1, len(r) + 1) for r in rankings if r])
+        uniq, inv = np.unique(np.array(ids), return_inverse=True)
+        scores = np.zeros(len(uniq))
+        np.add.at(scores, inv, 1. / (k + ranks))
+        order = np.argsort(scores * -1, kind="stable")
+        return uniq[order].tolist(), scores[order]
+
+    def hybrid_search(self, req, idxnm, emb_mdl, k=60):
+        """
+        Full text and kNN retrieval of the best `topk` chunks each, sent in a
+        single _msearch and fused by reciprocal rank. The page is cut from
+        the fused ranking by `from`, or `page`, and `size`.
+        """
+        qst = req.get("question", "")
+        ps = int(req.get("size", 10))
+        start = int(req.get("from", (int(req.get("page", 1)) - 1) * ps))
+        topk = max(int(req.get("topk", 64)), start + ps)
+        src = req.get("fields", ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd",
+                                 "image_id", "doc_id", "position_int", "available_int", "content_with_weight"])
+
+        bqry, keywords = self.qryr.question(qst)
+        bqry = self._add_filters(bqry, req)
+        mtch = Search().query(bqry)[0:topk]
+        if req.get("highlight"):
+            mtch = mtch.highlight("content_ltks").highlight("title_ltks")
+        knn = {"knn": self._vector(qst, emb_mdl, req.get("similarity", 0.1), topk), "size": topk}
+        knn["knn"]["filter"] = Q("bool", filter=bqry.filter).to_dict()
+        res = self.es.msearch([mtch.to_dict(), knn], idxnm=idxnm, src=src, timeout=req.get("timeout"))
+
+        ids, scores = self.rrf([self.es.getDocIds(r) for r in res], k)
+        hits = {}
+        for r in res:
+            for d in r["hits"]["hits"]:
+                hits.setdefault(d["_id"], d)
+        page = {"hits": {"hits": [hits[i] for i in ids[start:start + ps]]}}
+        return self.SearchResult(
+            total=len(ids),
+            ids=ids[start:start + ps],
+            query_vector=knn["knn"]["query_vector"],
+            field=self.getFields(page, src),
+            highlight=self.getHighlight(page),
+            keywords=keywords,
+            fused_score=dict(zip(ids[start:start + ps], scores[start:start + ps].tolist()))
+        )
+
+    def getScriptField(self, res, fld):
+        return {d["_id"]: d["fields"][fld][0] for d in res["hits"]["hits"] if fld in d.get("fields", {})}
+
+    def fetch_vectors(self, ids, idxnm):
+        """
+        The vectors of the given chunks as a numpy array, in the order of ids.
+        """
+        if not ids:
+            return np.array([])
+        if not self.es.vector_in_source:
+            vecs = {i: v for i, v in self.es.getVectors(Q("ids", values=ids), idxnm).items() if v}
+        else:
+            flds = self.es.VECTOR_FIELDS
+            res = self.es.search(Search().query(Q("ids", values=ids))[0:len(ids)].to_dict(),
+                                 idxnm=idxnm, src=flds)
+            vecs = {}
+            for d in self.es.getSource(res):
+                for f in flds:
+                    if d.get(f):
+                        vecs[d["id"]] = d[f]
+                        break
+        dim = len(next(iter(vecs.values()))) if vecs else 0
+        return np.array([vecs.get(i, [0] * dim) for i in ids])
+
     def getAggregation(self, res, g):
         if not "aggregations" in res or "aggs_" + g not in res["aggregations"]:
             return
@@ -284,29 +418,54 @@ class Dealer:
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks"):
         _, keywords = self.qryr.question(query)
+        if sres.vector_similarity is not None:
+            return self.rerank_by_similarity(sres, keywords, tkweight, vtweight, cfield)
         ins_embd = [
             Dealer.trans2floats(
                 sres.field[i].get("q_%d_vec" % len(sres.query_vector), "\t".join(["0"] * len(sres.query_vector)))) for i in sres.ids]
         if not ins_embd:
             return [], [], []
 
-        for i in sres.ids:
-            if isinstance(sres.field[i].get("important_kwd", []), str):
-                sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
-        ins_tw = []
-        for i in sres.ids:
-            content_ltks = sres.field[i][cfield].split(" ")
-            title_tks = [t for t in sres.field[i].get("title_tks", "").split(" ") if t]
-            important_kwd = sres.field[i].get("important_kwd", [])
-            tks = content_ltks + title_tks + important_kwd
-            ins_tw.append(tks)
-
+        ins_tw = self.rank_term_sets(sres, cfield)
         sim, tksim, vtsim = self.qryr.hybrid_similarity(sres.query_vector,
                                                         ins_embd,
                                                         keywords,
                                                         ins_tw, tkweight, vtweight)
         return sim, tksim, vtsim
 
+    def rerank_by_similarity(self, sres, keywords, tkweight, vtweight, cfield):
+        if not sres.ids:
+            return [], [], []
+        tksim = self.qryr.token_similarity(keywords, self.rank_term_sets(sres, cfield))
+        vtsim = np.array([sres.vector_similarity.get(i, 0) for i in sres.ids])
+        return vtsim * vtweight + np.array(tksim) * tkweight, tksim, vtsim
+
+    def rank_terms(self, d):
+        """
+        The terms rerank() matches the query against, computed from a chunk
+        at indexing time and stored as rank_terms_with_weight.
+        """
+        tks = rmSpace(d.get("content_ltks", "")).split(" ")
+        tks += [t for t in rmSpace(d.get("title_tks", "")).split(" ") if t]
+        kwd = d.get("important_kwd", [])
+        if kwd:
+            tks.append("\t".join([str(k) for k in kwd]) if isinstance(kwd, list) else str(kwd))
+        return "\t".join(sorted(self.qryr.tw.term_set(tks)))
+
+    def rank_term_sets(self, sres, cfield="content_ltks"):
+        ins_tw = []
+        for i in sres.ids:
+            fld = sres.field[i]
+            if isinstance(fld.get("important_kwd", []), str):
+                fld["important_kwd"] = [fld["important_kwd"]]
+            if cfield == "content_ltks" and fld.get("rank_terms_with_weight") is not None:
+                ins_tw.append(set([t for t in fld["rank_terms_with_weight"].split("\t") if t]))
+                continue
+            ins_tw.append(fld[cfield].split(" ") +
+                          [t for t in fld.get("title_tks", "").split(" ") if t] +
+                          fld.get("important_kwd", []))
+        return ins_tw
+
     def hybrid_similarity(self, ans_embd, ins_embd, ans, inst):
         return self.qryr.hybrid_similarity(ans_embd,
                                            ins_embd,
@@ -318,6 +477,14 @@ class Dealer:
         ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
         if not question:
             return ranks
+        cache_key = RETRIEVAL_CACHE.key(tenant_id, kb_ids, question, embd_mdl, page=page, page_size=page_size,
+                                        similarity_threshold=similarity_threshold,
+                                        vector_similarity_weight=vector_similarity_weight,
+                                        top=top, doc_ids=sorted(doc_ids or []), aggs=aggs)
+        if cache_key:
+            cached = RETRIEVAL_CACHE.get(cache_key)
+            if cached is not None:
+                return cached
         req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size,
                "question": question, "vector": True, "topk": top,
                "similarity": similarity_threshold}
@@ -327,7 +494,6 @@ class Dealer:
             sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
         idx = np.argsort(sim * -1)
 
-        dim = len(sres.query_vector)
         start_idx = (page - 1) * page_size
         for i in idx:
             if sim[i] < similarity_threshold:
@@ -355,7 +521,6 @@ class Dealer:
                 "similarity": sim[i],
                 "vector_similarity": vsim[i],
                 "term_similarity": tsim[i],
-                "vector": self.trans2floats(sres.field[id].get("q_%d_vec" % dim, "\t".join(["0"] * dim))),
                 "positions": sres.field[id].get("position_int", "").split("\t")
             }
             if len(d["positions"]) % 5 == 0:
@@ -374,6 +539,8 @@ class Dealer:
                              v in sorted(ranks["doc_aggs"].items(),
                                          key=lambda x:x[1]["count"] * -1)]
 
+        if cache_key:
+            RETRIEVAL_CACHE.put(cache_key, ranks)
         return ranks
 
     def sql_retrieval(self, sql, fetch_size=128, format="json"):
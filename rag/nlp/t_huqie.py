@@ -0,0 +1,134 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import random
+from timeit import default_timer as timer
+
+from hanziconv import HanziConv
+from api.utils.file_utils import traversal_files
+from rag.nlp import huqie, tokenize
+from rag.nlp.search import Dealer
+
+DEALER = Dealer(None)
+CACHES = [huqie.hq.qie_cache_, huqie.hq.qieqie_cache_, huqie.hq.term_cache_, DEALER.qryr.tw.cache_]
+SIZES = [c.maxsize for c in CACHES]
+
+
+def enable_cache(on):
+    for c, n in zip(CACHES, SIZES):
+        c.clear()
+        c.maxsize = n if on else 0
+
+
+def ingest(docs):
+    for title, chunks in docs:
+        doc = {"title_tks": huqie.qie(title)}
+        for ck in chunks:
+            d = dict(doc)
+            tokenize(d, ck, False)
+            DEALER.rank_terms(d)
+
+
+def ask(questions, candidates):
+    for q in questions:
+        _, keywords = DEALER.qryr.question(q)
+        DEALER.qryr.token_similarity(keywords, candidates)
+
+
+def char_by_char(line):
+    # what strQ2B and tradi2simp did before the translation tables
+    rstring = ""
+    for uchar in line:
+        inside_code = ord(uchar)
+        if inside_code == 0x3000:
+            inside_code = 0x0020
+        else:
+            inside_code -= 0xfee0
+        if inside_code < 0x0020 or inside_code > 0x7e:
+            rstring += uchar
+        else:
+            rstring += chr(inside_code)
+    return HanziConv.toSimplified(rstring)
+
+
+def normalize(lines):
+    chars = sum([len(l) for l in lines])
+    print("{:>14} {:>10} {:>14}".format("normalization", "seconds", "chars/second"))
+    res = {}
+    for name, f in [("char by char", char_by_char),
+                    ("translate", lambda l: huqie.tradi2simp(huqie.strQ2B(l)))]:
+        st = timer()
+        res[name] = [f(l) for l in lines]
+        el = timer() - st
+        print("{:>14} {:>10.2f} {:>14.0f}".format(name, el, chars / el))
+    assert res["char by char"] == res["translate"], "The normalizations differ"
+
+
+def load(inputs):
+    files = [f for f in traversal_files(inputs)] if os.path.isdir(inputs) else [inputs]
+    docs = []
+    for fnm in files:
+        with open(fnm, encoding="utf-8", errors="ignore") as f:
+            docs.append((os.path.splitext(os.path.basename(fnm))[0],
+                         [l.strip() for l in f if l.strip()]))
+    return docs
+
+
+def main(args):
+    docs = load(args.inputs)
+    lines = [ck for _, cks in docs for ck in cks]
+    questions = [l.strip() for l in open(args.questions, encoding="utf-8") if l.strip()] \
+        if args.questions else [random.choice(lines)[:64] for _ in range(args.queries)]
+    candidates = [huqie.qie(random.choice(lines)).split(" ") for _ in range(args.candidates)]
+
+    normalize(lines)
+    print("{:>10} {:>6} {:>6} {:>10}".format("path", "cache", "round", "seconds"))
+    for name, run in [("ingestion", lambda: ingest(docs)),
+                      ("query", lambda: ask(questions, candidates))]:
+        for on in [False, True]:
+            enable_cache(on)
+            for r in range(args.rounds):
+                st = timer()
+                run()
+                print("{:>10} {:>6} {:>6} {:>10.2f}".format(name, "on" if on else "off", r, timer() - st))
+        for k, v in list(huqie.cache_stats().items()) + [("weights", DEALER.qryr.tw.cache_.stats())]:
+            print("    {:<8} hit rate {:.2%} of {} lookups, {} entries".format(
+                k, v["hit_rate"], v["hits"] + v["misses"], v["size"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Normalization speed, and tokenization time of ingestion and retrieval with and without the huqie caches.")
+    parser.add_argument('--inputs',
+                        help="Directory of text files, or a single text file. Every line is a chunk",
+                        required=True)
+    parser.add_argument('--questions', help="Text file with a question per line. Default: sampled from the inputs")
+    parser.add_argument('--queries', help="Number of sampled questions. Default: 200", type=int, default=200)
+    parser.add_argument('--candidates', help="Chunks reranked per question. Default: 64", type=int, default=64)
+    parser.add_argument('--rounds', help="Runs of every path, the first one with cold caches. Default: 2",
+                        type=int, default=2)
+    args = parser.parse_args()
+    main(args)
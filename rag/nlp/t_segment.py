@@ -0,0 +1,74 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+from timeit import default_timer as timer
+
+from api.utils.file_utils import traversal_files
+from rag.nlp import huqie
+
+
+def segment(lines, engine):
+    huqie.hq.ENGINE = engine
+    huqie.hq.clear_cache()
+    st = timer()
+    qie = [huqie.hq.qie_(huqie.tradi2simp(huqie.strQ2B(l).lower())) for l in lines]
+    qieqie = [huqie.hq.qieqie_(tks) for tks in qie]
+    return timer() - st, qie, qieqie
+
+
+def main(args):
+    files = [f for f in traversal_files(args.inputs)] if os.path.isdir(args.inputs) else [args.inputs]
+    lines = []
+    for fnm in files:
+        with open(fnm, encoding="utf-8", errors="ignore") as f:
+            lines.extend([l.strip() for l in f if l.strip()])
+    chars = sum([len(l) for l in lines])
+
+    res = {}
+    for engine in ["dfs", "dp"]:
+        res[engine] = segment(lines, engine)
+        print("{:>4}: {:>10.2f} seconds {:>12.0f} chars/second".format(engine, res[engine][0], chars / res[engine][0]))
+
+    diff = 0
+    for i, l in enumerate(lines):
+        if res["dfs"][1][i] == res["dp"][1][i] and res["dfs"][2][i] == res["dp"][2][i]:
+            continue
+        diff += 1
+        print("[DIFF]", l)
+        print("   dfs:", res["dfs"][1][i], "|", res["dfs"][2][i])
+        print("    dp:", res["dp"][1][i], "|", res["dp"][2][i])
+    print("{} of {} lines are segmented differently".format(diff, len(lines)))
+    sys.exit(1 if diff else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Checks that the 'dp' segmentation engine of huqie gives the output of 'dfs', and compares their throughput.")
+    parser.add_argument('--inputs',
+                        help="Directory of text files, or a single text file",
+                        required=True)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,75 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import random
+from timeit import default_timer as timer
+
+import numpy as np
+
+from rag.nlp import huqie
+from rag.nlp.query import EsQueryer
+
+
+def loop(qryr, atks, btkss):
+    # Token similarity of the candidates one by one, as reranking used to.
+    def toDict(tks):
+        d = {}
+        for t, c in qryr.tw.weights(tks):
+            d[t] = d.get(t, 0) + c
+        return d
+    atks = toDict(atks)
+    return [qryr.similarity(atks, toDict(tks)) for tks in btkss]
+
+
+def main(args):
+    with open(args.inputs, encoding="utf-8") as f:
+        lines = [l.strip() for l in f if l.strip()]
+    btkss = [huqie.qie(random.choice(lines)).split(" ") for _ in range(args.candidates)]
+    qryr = EsQueryer(None)
+    _, keywords = qryr.question(args.question)
+
+    st = timer()
+    old = loop(qryr, keywords, btkss)
+    print("loop:               {:.3f}s".format(timer() - st))
+    st = timer()
+    new = qryr.token_similarity(keywords, btkss)
+    print("vectorized:         {:.3f}s".format(timer() - st))
+    sets = [qryr.tw.term_set(tks) for tks in btkss]
+    st = timer()
+    pre = qryr.token_similarity(keywords, sets)
+    print("precomputed terms:  {:.3f}s".format(timer() - st))
+    print("max abs difference: {:.2e}".format(max(np.max(np.abs(np.array(old) - np.array(new))),
+                                                  np.max(np.abs(np.array(old) - np.array(pre))))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Token similarity time of reranking, per-candidate loop versus vectorized.")
+    parser.add_argument('--inputs', help="Text file whose lines are used as chunks", required=True)
+    parser.add_argument('--question', help="Query text", required=True)
+    parser.add_argument('--candidates', help="Number of candidates. Default: 1024", type=int, default=1024)
+    args = parser.parse_args()
+    main(args)
@@ -6,6 +6,8 @@ import os
 import numpy as np
 from rag.nlp import huqie
 from api.utils.file_utils import get_project_base_directory
+from rag.settings import HUQIE
+from rag.utils.cache import LRUCache
 
 
 class Dealer:
@@ -73,6 +75,9 @@ class Dealer:
         except Exception as e:
             print("[WARNING] Load term.freq FAIL!")
 
+        self.MAX_CACHED_LEN = int(HUQIE.get("max_length", 1024))
+        self.cache_ = LRUCache(int(HUQIE.get("cache_size", 10000)))
+
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [
             r"[~—\t @#%!<>,\.\?\":;'\{\}\[\]_=\(\)\|，。？》•●○↓《；‘’：“”【¥ 】…￥！、·（）×`&\\/「」\\]"
@@ -143,7 +148,23 @@ class Dealer:
                 tks.append(t)
         return tks
 
+    def term_set(self, tks):
+        """The distinct terms weights() would produce for tks, without weighting them."""
+        if isinstance(tks, str):
+            tks = tks.split(" ")
+        return set([t for tk in tks for t in self.tokenMerge(self.pretoken(tk, True))])
+
     def weights(self, tks):
+        if sum([len(tk) for tk in tks]) > self.MAX_CACHED_LEN:
+            return self.weights_(tks)
+        key = tuple(tks)
+        tw = self.cache_.get(key)
+        if tw is None:
+            tw = self.weights_(tks)
+            self.cache_.put(key, tw)
+        return list(tw)
+
+    def weights_(self, tks):
         def skill(t):
             if t not in self.sk:
                 return 1
@@ -31,6 +31,13 @@ except Exception as e:
     REDIS = {}
     pass
 DOC_MAXIMUM_SIZE = 128 * 1024 * 1024
+TASK_EXECUTOR = get_base_config("task_executor", {})
+EMBEDDING_CACHE = get_base_config("embedding_cache", {})
+EMBEDDING_DRIVER = get_base_config("embedding_driver", {})
+DEEPDOC = get_base_config("deepdoc", {})
+HUQIE = get_base_config("huqie", {})
+RETRIEVAL_CACHE = get_base_config("retrieval_cache", {})
+INDEX_PLACEMENT = get_base_config("index_placement", {})
 
 # Logger
 LoggerFactory.set_directory(
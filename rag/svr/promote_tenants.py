@@ -0,0 +1,62 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import json
+
+from api.db.services.knowledgebase_service import KnowledgebaseService
+from api.utils.file_utils import get_project_base_directory
+from rag.nlp import search
+from rag.utils import ELASTICSEARCH
+from rag.utils.index_placement import INDEX_PLACEMENT, PooledPlacement
+
+
+def main(args):
+    if not isinstance(INDEX_PLACEMENT, PooledPlacement):
+        print("index_placement.strategy isn't 'pooled', no tenant to promote.")
+        return
+    for tenant_id, chunk_num in KnowledgebaseService.get_chunk_num_of_tenants(INDEX_PLACEMENT.dedicated_chunks):
+        if args.tenant_id and tenant_id != args.tenant_id:
+            continue
+        idxnm = search.index_name(tenant_id)
+        pool = INDEX_PLACEMENT.pool(tenant_id)
+        if ELASTICSEARCH.concreteIndex(idxnm) != pool:
+            continue
+        print("Tenant {} has {} chunks in {}.".format(tenant_id, chunk_num, pool))
+        if args.dry_run:
+            continue
+        mapping = json.load(open(os.path.join(get_project_base_directory(), "conf", "mapping.json"), "r"))
+        print("Moved to {}.".format(INDEX_PLACEMENT.promote(idxnm, tenant_id, mapping, chunk_num)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move the tenants which have outgrown their shared index, i.e. have at least "
+                    "index_placement.dedicated_chunks chunks, to indices of their own. "
+                    "Nothing may be parsed into a tenant while it moves, so stop the task executors first.")
+    parser.add_argument('--tenant_id', help="Only this tenant. Default: all of them", default="")
+    parser.add_argument('--dry_run', help="Only list the tenants to move", action="store_true")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+from api.db.db_models import Task, close_connection
+from api.db.db_utils import bulk_insert_into_db
+from api.db.services.task_service import TaskService
+from api.utils import get_uuid
+
+
+def claim(_):
+    n = 0
+    while TaskService.get_tasks(0):
+        n += 1
+    close_connection()
+    return n
+
+
+def main(args):
+    print("{:>8} {:>10} {:>12}".format("workers", "seconds", "claims/sec"))
+    for workers in [int(w) for w in args.workers.split(",")]:
+        ids = [get_uuid() for _ in range(args.tasks)]
+        bulk_insert_into_db(Task, [{"id": i, "doc_id": args.doc_id} for i in ids], True)
+        try:
+            with Pool(processes=workers) as pool:
+                st = timer()
+                n = sum(pool.map(claim, range(workers)))
+                el = timer() - st
+        finally:
+            Task.delete().where(Task.id.in_(ids)).execute()
+        print("{:>8} {:>10.2f} {:>12.2f}".format(workers, el, n / el))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Task claims per second versus the number of competing workers. "
+                    "It inserts dummy tasks for a document which must be valid and in running state, "
+                    "so make sure no task executor is running against the same database.")
+    parser.add_argument('--doc_id', help="Id of the document the dummy tasks belong to", required=True)
+    parser.add_argument('--tasks', help="Number of tasks to claim for every worker count. Default: 2000",
+                        type=int, default=2000)
+    parser.add_argument('--workers', help="Comma separated worker counts. Default: '1,4,16,32'",
+                        default="1,4,16,32")
+    args = parser.parse_args()
+    main(args)
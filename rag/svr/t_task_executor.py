@@ -0,0 +1,91 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import multiprocessing
+from timeit import default_timer as timer
+
+from api.db.db_models import Task
+from api.db.db_utils import bulk_insert_into_db
+from api.db.services.document_service import DocumentService
+from api.utils import get_uuid
+from rag.svr.task_executor import concurrent_main, REPORTER
+
+
+def unfinished(ids):
+    REPORTER.flush()
+    return Task.select().where(Task.id.in_(ids), Task.progress >= 0, Task.progress < 1).count()
+
+
+def run(args, slots, results):
+    _, doc = DocumentService.get_by_id(args.doc_id)
+    ids = [get_uuid() for _ in range(args.tasks)]
+    bulk_insert_into_db(Task, [{"id": i, "doc_id": doc.id, "from_page": 0, "to_page": args.pages}
+                               for i in ids], True)
+    _, before = DocumentService.get_by_id(doc.id)
+    try:
+        st = timer()
+        # Fetching, chunking, embedding and indexing, as the executor does.
+        concurrent_main(1, 0, slots, until=lambda: unfinished(ids) == 0)
+        el = timer() - st
+        failed = Task.select().where(Task.id.in_(ids), Task.progress < 0).count()
+    finally:
+        Task.delete().where(Task.id.in_(ids)).execute()
+        # Every task indexed the same chunks again, take back what they counted.
+        _, after = DocumentService.get_by_id(doc.id)
+        DocumentService.increment_chunk_num(doc.id, doc.kb_id, before.token_num - after.token_num,
+                                            before.chunk_num - after.chunk_num, 0)
+    results.put((el, failed))
+
+
+def main(args):
+    # concurrent_main forks its chunk pool before starting any thread and
+    # leaves its heartbeat running, so every slot count gets a fresh process.
+    ctx = multiprocessing.get_context("spawn")
+    print("{:>6} {:>10} {:>12} {:>8}".format("slots", "seconds", "tasks/minute", "failed"))
+    for slots in [int(s) for s in args.slots.split(",")]:
+        results = ctx.Queue()
+        p = ctx.Process(target=run, args=(args, slots, results))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            print("{:>6} exited with {}".format(slots, p.exitcode))
+            continue
+        el, failed = results.get()
+        print("{:>6} {:>10.2f} {:>12.2f} {:>8}".format(slots, el, args.tasks * 60. / el, failed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="End-to-end task throughput of the task executor versus the number of task slots. "
+                    "It queues tasks parsing a document again and again, which must be valid "
+                    "and in running state, so make sure no task executor is running "
+                    "against the same database.")
+    parser.add_argument('--doc_id', help="Id of the document the tasks parse", required=True)
+    parser.add_argument('--tasks', help="Tasks for every slot count. Default: 32", type=int, default=32)
+    parser.add_argument('--pages', help="Pages every task parses. Default: 12", type=int, default=12)
+    parser.add_argument('--slots', help="Comma separated slot counts. Default: '1,2,4,8'", default="1,2,4,8")
+    args = parser.parse_args()
+    main(args)
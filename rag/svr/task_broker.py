@@ -20,11 +20,11 @@ import random
 from datetime import datetime
 from api.db.db_models import Task
 from api.db.db_utils import bulk_insert_into_db
-from api.db.services.task_service import TaskService
+from api.db.services.task_service import TaskService, PROGRESS_CHANGED
 from deepdoc.parser import PdfParser
 from deepdoc.parser.excel_parser import HuExcelParser
-from rag.settings import cron_logger
-from rag.utils import MINIO
+from rag.settings import cron_logger, TASK_EXECUTOR
+from rag.utils import MINIO, ELASTICSEARCH
 from rag.utils import findMaxTm
 import pandas as pd
 from api.db import FileType, TaskStatus
@@ -36,6 +36,18 @@ from rag.utils.redis_conn import REDIS_CONN
 from api.db.db_models import init_database_tables as init_web_db
 from api.db.init_data import init_web_data
 
+# Every this many seconds, and whenever Redis is out, all the unfinished
+# documents are rolled up instead of only the ones whose tasks changed.
+FULL_SCAN_INTERVAL = 60
+LAST_FULL_SCAN = 0
+# doc id -> the last (progress, status, message) written to the document
+DOC_ROLLUPS = {}
+# task id -> doc id
+TASK_DOCS = {}
+# Every this many seconds, the refresh intervals left relaxed are restored.
+RESTORE_INTERVAL = 60
+LAST_RESTORE = 0
+
 
 def collect(tm):
     docs = DocumentService.get_newly_uploaded(tm)
@@ -137,11 +149,52 @@ def dispatch():
     tmf.close()
 
 
+def changed_docs():
+    """
+    Ids of the documents whose tasks published a progress change,
+    or None if Redis is unavailable.
+    """
+    if not REDIS_CONN.is_alive():
+        return
+    ids = set([])
+    while True:
+        tids = REDIS_CONN.spop(PROGRESS_CHANGED, 1024)
+        if tids is None:
+            return
+        ids.update([t.decode("utf-8") if isinstance(t, bytes) else t for t in tids])
+        if len(tids) < 1024:
+            break
+    if len(TASK_DOCS) > 100000:
+        TASK_DOCS.clear()
+    unknown = [t for t in ids if t not in TASK_DOCS]
+    if unknown:
+        TASK_DOCS.update(TaskService.get_doc_ids(unknown))
+    return set([TASK_DOCS[t] for t in ids if t in TASK_DOCS])
+
+
 def update_progress():
-    docs = DocumentService.get_unfinished_docs()
+    global LAST_FULL_SCAN
+    doc_ids = None
+    if time.time() - LAST_FULL_SCAN < FULL_SCAN_INTERVAL:
+        doc_ids = changed_docs()
+    if doc_ids is None:
+        LAST_FULL_SCAN = time.time()
+        docs = DocumentService.get_unfinished_docs()
+        for k in set(DOC_ROLLUPS.keys()) - set([d["id"] for d in docs]):
+            del DOC_ROLLUPS[k]
+    elif doc_ids:
+        docs = DocumentService.get_unfinished_docs(doc_ids)
+    else:
+        return
+    if not docs:
+        return
+
+    tasks = {}
+    for t in TaskService.get_by_doc_ids([d["id"] for d in docs]):
+        tasks.setdefault(t.doc_id, []).append(t)
     for d in docs:
         try:
-            tsks = TaskService.query(doc_id=d["id"], order_by=Task.create_time)
+            tsks = tasks.get(d["id"])
             if not tsks:
                 continue
             msg = []
@@ -164,6 +217,9 @@ def update_progress():
                 status = TaskStatus.DONE.value
 
             msg = "\n".join(msg)
+            rollup = (prg, status, msg)
+            if DOC_ROLLUPS.get(d["id"]) == rollup:
+                continue
             info = {
                 "process_duation": datetime.timestamp(
                     datetime.now()) -
@@ -174,10 +230,37 @@ def update_progress():
             if msg:
                 info["progress_msg"] = msg
             DocumentService.update_by_id(d["id"], info)
+            if finished:
+                DOC_ROLLUPS.pop(d["id"], None)
+            else:
+                DOC_ROLLUPS[d["id"]] = rollup
         except Exception as e:
             cron_logger.error("fetch task exception:" + str(e))
 
 
+def requeue():
+    try:
+        num = TaskService.requeue_stale(float(TASK_EXECUTOR.get("visibility_timeout", 600)),
+                                        int(TASK_EXECUTOR.get("max_retries", 3)))
+        if num:
+            cron_logger.warning("Re-queued {} stale tasks.".format(num))
+    except Exception as e:
+        cron_logger.error("requeue exception:" + str(e))
+
+
+def restore_refresh_intervals():
+    global LAST_RESTORE
+    if time.time() - LAST_RESTORE < RESTORE_INTERVAL:
+        return
+    LAST_RESTORE = time.time()
+    try:
+        idxnms = ELASTICSEARCH.restoreRefreshIntervals()
+        if idxnms:
+            cron_logger.warning("Restored the refresh interval of {}.".format(", ".join(idxnms)))
+    except Exception as e:
+        cron_logger.error("restore refresh interval exception:" + str(e))
+
+
 if __name__ == "__main__":
     peewee_logger = logging.getLogger('peewee')
     peewee_logger.propagate = False
@@ -191,3 +274,5 @@ if __name__ == "__main__":
         dispatch()
         time.sleep(1)
         update_progress()
+        requeue()
+        restore_refresh_intervals()
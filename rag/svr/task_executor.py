@@ -19,15 +19,19 @@ import logging
 import os
 import hashlib
 import copy
+import queue
 import re
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from functools import partial
 from rag.utils import MINIO
 from api.db.db_models import close_connection
 from rag.settings import database_logger
-from rag.settings import cron_logger, DOC_MAXIMUM_SIZE
+from rag.settings import cron_logger, DOC_MAXIMUM_SIZE, TASK_EXECUTOR
 from multiprocessing import Pool
 import numpy as np
 from elasticsearch_dsl import Q
@@ -43,13 +47,22 @@ import pandas as pd
 
 from rag.app import laws, paper, presentation, manual, qa, table, book, resume, picture, naive, one
 
-from api.db import LLMType, ParserType
+from api.db import FileType, LLMType, ParserType
 from api.db.services.document_service import DocumentService
+from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.llm_service import LLMBundle
+from api.settings import retrievaler
+from rag.nlp.retrieval_cache import RETRIEVAL_CACHE
+from rag.llm.embedding_driver import EMBEDDING_DRIVER
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.index_placement import INDEX_PLACEMENT
 from rag.utils.redis_conn import REDIS_CONN
 
 BATCH_SIZE = 64
+PIPELINE_DEPTH = 4
+FETCH_POOL = ThreadPoolExecutor(max_workers=8)
+# Ids of the tasks this process is working on, kept alive by heartbeat().
+INFLIGHT = set()
 
 FACTORY = {
     "general": naive,
@@ -66,33 +79,121 @@ FACTORY = {
     ParserType.ONE.value: one,
 }
 
+# Parsers which lay out a PDF page by page, so any page range parses alone.
+PAGED_PARSERS = {
+    ParserType.NAIVE.value,
+    ParserType.PAPER.value,
+    ParserType.BOOK.value,
+    ParserType.LAWS.value,
+    ParserType.MANUAL.value,
+    ParserType.PRESENTATION.value,
+}
+
+
+class ProgressReporter:
+    """
+    Coalesces the progress updates of tasks. Messages are buffered per task and
+    written together with the latest progress in one statement at most once per
+    `window` seconds, final progress (done, failed or canceled) right away.
+    The cancel flag of a task is cached for `cancel_ttl` seconds.
+    """
+
+    def __init__(self, window=1., cancel_ttl=3.):
+        self.window = window
+        self.cancel_ttl = cancel_ttl
+        self.pid = None
+
+    def __start(self):
+        # Also runs again in forked chunk workers, which inherit no thread.
+        with REPORTER_LOCK:
+            if self.pid == os.getpid():
+                return
+            self.lock = threading.Lock()
+            self.flush_lock = threading.Lock()
+            self.pending = {}
+            self.last_flush = {}
+            self.canceled = {}
+            threading.Thread(target=self.__run, daemon=True).start()
+            self.pid = os.getpid()
+
+    def __run(self):
+        while True:
+            time.sleep(self.window)
+            self.flush()
+
+    def is_canceled(self, task_id):
+        c = self.canceled.get(task_id)
+        if c is not None and time.time() - c[1] < self.cancel_ttl:
+            return c[0]
+        cancel = TaskService.do_cancel(task_id)
+        self.canceled[task_id] = (cancel, time.time())
+        return cancel
+
+    def report(self, task_id, prog=None, msg=""):
+        if self.pid != os.getpid():
+            self.__start()
+        cancel = self.is_canceled(task_id)
+        if cancel:
+            msg += " [Canceled]"
+            prog = -1
+        final = prog is not None and (prog >= 1 or prog < 0)
+        with self.lock:
+            p = self.pending.setdefault(task_id, {"msgs": [], "progress": None})
+            if msg:
+                p["msgs"].append(msg)
+            if prog is not None:
+                p["progress"] = prog
+            due = time.time() - self.last_flush.get(task_id, 0) >= self.window
+        if final or due:
+            self.flush(task_id)
+        if final:
+            self.last_flush.pop(task_id, None)
+            self.canceled.pop(task_id, None)
+        return cancel
+
+    def flush(self, task_id=None):
+        if self.pid != os.getpid():
+            return
+        with self.flush_lock:
+            with self.lock:
+                ids = [task_id] if task_id else list(self.pending.keys())
+                items = [(i, self.pending.pop(i)) for i in ids if i in self.pending]
+                now = time.time()
+                # Drop the tasks which went quiet, e.g. the ones which died.
+                for i in [i for i, t in self.last_flush.items() if now - t >= self.window]:
+                    del self.last_flush[i]
+                for i in [i for i, c in self.canceled.items() if now - c[1] >= self.cancel_ttl]:
+                    self.canceled.pop(i, None)
+                for i, _ in items:
+                    self.last_flush[i] = now
+            for i, p in items:
+                d = {"progress_msg": "\n".join(p["msgs"])}
+                if p["progress"] is not None:
+                    d["progress"] = p["progress"]
+                try:
+                    TaskService.update_progress(i, d)
+                except Exception as e:
+                    cron_logger.error("set_progress:({}), {}".format(i, str(e)))
+
+
+REPORTER_LOCK = threading.Lock()
+REPORTER = ProgressReporter()
+
 
 def set_progress(task_id, from_page=0, to_page=-1,
                  prog=None, msg="Processing..."):
     if prog is not None and prog < 0:
         msg = "[ERROR]" + msg
-    cancel = TaskService.do_cancel(task_id)
-    if cancel:
-        msg += " [Canceled]"
-        prog = -1
 
     if to_page > 0:
         if msg:
             msg = f"Page({from_page+1}~{to_page+1}): " + msg
-    d = {"progress_msg": msg}
-    if prog is not None:
-        d["progress"] = prog
-    try:
-        TaskService.update_progress(task_id, d)
-    except Exception as e:
-        cron_logger.error("set_progress:({}), {}".format(task_id, str(e)))
-
-    if cancel:
+    if REPORTER.report(task_id, prog, msg):
         sys.exit()
 
 
-def collect(comm, mod, tm):
-    tasks = TaskService.get_tasks(tm, mod, comm)
+def collect(comm, mod, tm, items_per_page=1):
+    tasks = TaskService.get_tasks(tm, mod, comm, items_per_page)
     #print(tasks)
     if len(tasks) == 0:
         time.sleep(1)
@@ -103,6 +204,20 @@ def collect(comm, mod, tm):
     return tasks
 
 
+def heartbeat():
+    """
+    Touch the in-flight tasks well within the visibility timeout, so the
+    broker only re-queues the tasks of executors that are gone.
+    """
+    interval = max(float(TASK_EXECUTOR.get("visibility_timeout", 600)) / 3., 1.)
+    while True:
+        time.sleep(interval)
+        try:
+            TaskService.heartbeat(set(INFLIGHT))
+        except Exception as e:
+            cron_logger.error("heartbeat: {}".format(str(e)))
+
+
 def get_minio_binary(bucket, name):
     global MINIO
     if REDIS_CONN.is_alive():
@@ -114,43 +229,110 @@ def get_minio_binary(bucket, name):
     return MINIO.get(bucket, name)
 
 
-def build(row):
-    if row["size"] > DOC_MAXIMUM_SIZE:
-        set_progress(row["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
-                     (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
-        return []
-
+def do_chunk(row, binary):
+    """
+    Run the CPU-bound chunker for a task. It is the unit of work shipped to
+    the chunk pool in concurrent mode, so it must stay a module level function.
+    """
     callback = partial(
         set_progress,
         row["id"],
         row["from_page"],
         row["to_page"])
     chunker = FACTORY[row["parser_id"].lower()]
-    pool = Pool(processes=1)
+    try:
+        return chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
+                             to_page=row["to_page"], lang=row["language"], callback=callback,
+                             kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
+    except SystemExit:
+        # canceled, set_progress has already recorded it
+        return None
+    finally:
+        REPORTER.flush()
+
+
+def fetch(row, chunk_pool=None):
+    """
+    Get the file content of a task, or None once the failure has been reported.
+    """
+    callback = partial(
+        set_progress,
+        row["id"],
+        row["from_page"],
+        row["to_page"])
+    pool = Pool(processes=1) if chunk_pool is None else None
     try:
         st = timer()
-        thr = pool.apply_async(get_minio_binary, args=(row["kb_id"], row["location"]))
-        binary = thr.get(timeout=90)
-        pool.terminate()
+        if pool is not None:
+            thr = pool.apply_async(get_minio_binary, args=(row["kb_id"], row["location"]))
+            binary = thr.get(timeout=90)
+            pool.terminate()
+        else:
+            binary = FETCH_POOL.submit(get_minio_binary, row["kb_id"], row["location"]).result(timeout=90)
         cron_logger.info(
             "From minio({}) {}/{}".format(timer()-st, row["location"], row["name"]))
-        cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
-                            to_page=row["to_page"], lang=row["language"], callback=callback,
-                            kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
-        cron_logger.info(
-            "Chunkking({}) {}/{}".format(timer()-st, row["location"], row["name"]))
-    except TimeoutError as e:
+        return binary
+    except (TimeoutError, FutureTimeoutError) as e:
         callback(-1, f"Internal server error: Fetch file timeout. Could you try it again.")
         cron_logger.error(
             "Chunkking {}/{}: Fetch file timeout.".format(row["location"], row["name"]))
-        return
     except Exception as e:
         if re.search("(No such file|not found)", str(e)):
             callback(-1, "Can not find file <%s>" % row["name"])
         else:
             callback(-1, f"Internal server error: %s" %
                      str(e).replace("'", ""))
+        traceback.print_exc()
+        cron_logger.error(
+            "Chunkking {}/{}: {}".format(row["location"], row["name"], str(e)))
+    if pool is not None:
         pool.terminate()
+
+
+def page_ranges(row):
+    """
+    Split the page range of a task into pieces of `task_executor.pipeline_pages`
+    pages, so the first pieces can be embedded and indexed while the later ones
+    are still being parsed. Only the PDFs of page based layout parsers are
+    split, other tasks have to be chunked as a whole.
+    """
+    pages = int(TASK_EXECUTOR.get("pipeline_pages", 0))
+    if pages <= 0 or row["to_page"] - row["from_page"] <= pages:
+        return [row]
+    if row["type"] != FileType.PDF.value or row["parser_id"].lower() not in PAGED_PARSERS \
+            or not (row["parser_config"] or {}).get("layout_recognize", True):
+        return [row]
+    rows = []
+    for p in range(row["from_page"], row["to_page"], pages):
+        r = row.copy()
+        r["from_page"] = p
+        r["to_page"] = min(p + pages, row["to_page"])
+        rows.append(r)
+    return rows
+
+
+def build(row, binary, chunk_pool=None):
+    callback = partial(
+        set_progress,
+        row["id"],
+        row["from_page"],
+        row["to_page"])
+    chunker = FACTORY[row["parser_id"].lower()]
+    try:
+        st = timer()
+        if chunk_pool is None:
+            cks = chunker.chunk(row["name"], binary=binary, from_page=row["from_page"],
+                                to_page=row["to_page"], lang=row["language"], callback=callback,
+                                kb_id=row["kb_id"], parser_config=row["parser_config"], tenant_id=row["tenant_id"])
+        else:
+            cks = chunk_pool.apply(do_chunk, (row.to_dict(), binary))
+            if cks is None:
+                return
+        cron_logger.info(
+            "Chunkking({}) {}/{}".format(timer()-st, row["location"], row["name"]))
+    except Exception as e:
+        callback(-1, f"Internal server error: %s" %
+                 str(e).replace("'", ""))
         traceback.print_exc()
 
         cron_logger.error(
@@ -171,6 +353,7 @@ def build(row):
         md5.update((ck["content_with_weight"] +
                    str(d["doc_id"])).encode("utf-8"))
         d["_id"] = md5.hexdigest()
+        d["rank_terms_with_weight"] = retrievaler.rank_terms(d)
         d["create_time"] = str(datetime.datetime.now()).replace("T", " ")[:19]
         d["create_timestamp_flt"] = datetime.datetime.now().timestamp()
         if not d.get("image"):
@@ -198,53 +381,219 @@ def init_kb(row):
     idxnm = search.index_name(row["tenant_id"])
     if ELASTICSEARCH.indexExist(idxnm):
         return
-    return ELASTICSEARCH.createIdx(idxnm, json.load(
-        open(os.path.join(get_project_base_directory(), "conf", "mapping.json"), "r")))
+    return INDEX_PLACEMENT.create(idxnm, row["tenant_id"], json.load(
+        open(os.path.join(get_project_base_directory(), "conf", "mapping.json"), "r")),
+        KnowledgebaseService.get_chunk_num_by_tenant(row["tenant_id"]))
+
+
+def remove_chunks(row, idxnm):
+    ELASTICSEARCH.deleteByQuery(Q("match", doc_id=row["doc_id"]), idxnm=idxnm)
+    # Retrievals cached while the task was indexing may point at them.
+    RETRIEVAL_CACHE.invalidate([row["kb_id"]])
 
 
 def embedding(docs, mdl, parser_config={}, callback=None):
-    batch_size = 32
+    # Every call carries enough batches of 32 to keep all the concurrent
+    # requests of a remote model busy.
+    batch_size = 32 * EMBEDDING_DRIVER.concurrency
     tts, cnts = [rmSpace(d["title_tks"]) for d in docs if d.get("title_tks")], [
         re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", d["content_with_weight"]) for d in docs]
     tk_count = 0
     if len(tts) == len(cnts):
         tts_ = np.array([])
         for i in range(0, len(tts), batch_size):
-            vts, c = mdl.encode(tts[i: i + batch_size])
+            vts, c = mdl.encode(tts[i: i + batch_size], 32)
             if len(tts_) == 0:
-                tts_ = vts                
-                cron_logger.error(len(vts))
+                tts_ = vts
             else:
                 tts_ = np.concatenate((tts_, vts), axis=0)
             tk_count += c
-            callback(prog=0.6 + 0.1 * (i + 1) / len(tts), msg="")
+            if callback:
+                callback(prog=0.6 + 0.1 * (i + 1) / len(tts), msg="")
         tts = tts_
 
     cnts_ = np.array([])
     for i in range(0, len(cnts), batch_size):
-        vts, c = mdl.encode(cnts[i: i + batch_size])
+        vts, c = mdl.encode(cnts[i: i + batch_size], 32)
         if len(cnts_) == 0:
             cnts_ = vts
-            cron_logger.error(len(vts))
         else:
             cnts_ = np.concatenate((cnts_, vts), axis=0)
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
+        if callback:
+            callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
     cnts = cnts_
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
     vects = (title_w * tts + (1 - title_w) *
              cnts) if len(tts) == len(cnts) else cnts
 
-    cron_logger.error(len(vects), len(docs))
+    cron_logger.debug("Embedded {} chunks into {} vectors.".format(len(docs), len(vects)))
     assert len(vects) == len(docs)
     for i, d in enumerate(docs):
         v = vects[i].tolist()
-        cron_logger.error(len(v))
         d["q_%d_vec" % len(v)] = v
     return tk_count
 
 
+def do_handle_task(r, chunk_pool=None):
+    """
+    Chunk, embed and index one task.
+    The three stages run as a pipeline connected by bounded queues: batches
+    of chunks are embedded while the rest of the pages are still being parsed,
+    and embedded batches go to ES while the later ones are still embedding.
+    Returns True when the task's update time should be recorded.
+    """
+    callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    #callback(random.random()/10., "Task has been received.")
+    try:
+        embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except Exception as e:
+        traceback.print_stack(e)
+        callback(prog=-1, msg=str(e))
+        return False
+
+    if r["size"] > DOC_MAXIMUM_SIZE:
+        set_progress(r["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
+                     (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
+        callback(1., "No chunk! Done!")
+        return True
+
+    binary = fetch(r, chunk_pool)
+    if binary is None:
+        return False
+
+    st = timer()
+    idxnm = search.index_name(r["tenant_id"])
+    chunk_queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    vector_queue = queue.Queue(maxsize=PIPELINE_DEPTH)
+    aborted = threading.Event()
+    stat = {"chunks": 0, "tk_count": 0, "sliced": False, "failed": False}
+
+    def put(q, item):
+        while True:
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                if aborted.is_set():
+                    return
+
+    def get(q, producer):
+        while True:
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                if aborted.is_set() and not producer.is_alive():
+                    return
+
+    def slice_stage():
+        try:
+            for row in page_ranges(r):
+                cks = build(row, binary, chunk_pool)
+                if cks is None:
+                    stat["failed"] = True
+                    aborted.set()
+                    return
+                stat["chunks"] += len(cks)
+                for i in range(0, len(cks), BATCH_SIZE):
+                    put(chunk_queue, cks[i: i + BATCH_SIZE])
+                    if aborted.is_set():
+                        return
+            stat["sliced"] = True
+            cron_logger.info("Build chunks({}): {}".format(r["name"], timer()-st))
+            if stat["chunks"]:
+                callback(msg="Finished slicing files(%d)." % stat["chunks"])
+        except BaseException as e:
+            # SystemExit means canceled, set_progress has already recorded it
+            if not isinstance(e, SystemExit):
+                callback(-1, "Internal server error: %s" % str(e).replace("'", ""))
+                traceback.print_exc()
+            stat["failed"] = True
+            aborted.set()
+        finally:
+            put(chunk_queue, None)
+
+    def embedding_stage():
+        try:
+            while True:
+                cks = get(chunk_queue, slicer)
+                if cks is None:
+                    break
+                if aborted.is_set():
+                    continue
+                stat["tk_count"] += embedding(cks, embd_mdl, r["parser_config"])
+                put(vector_queue, cks)
+        except Exception as e:
+            callback(-1, "Embedding error:{}".format(str(e)))
+            cron_logger.error("Embedding error:{}".format(str(e)))
+            stat["failed"] = True
+            aborted.set()
+        finally:
+            put(vector_queue, None)
+
+    slicer = threading.Thread(target=slice_stage, daemon=True)
+    embedder = threading.Thread(target=embedding_stage, daemon=True)
+    slicer.start()
+    embedder.start()
+
+    chunk_ids, indexed, es_r, ingesting = set([]), 0, None, False
+    try:
+        while True:
+            cks = get(vector_queue, embedder)
+            if cks is None:
+                break
+            if aborted.is_set():
+                continue
+            if not ingesting:
+                init_kb(r)
+                ELASTICSEARCH.beginIngest(idxnm)
+                ingesting = True
+            chunk_ids.update([c["_id"] for c in cks])
+            es_r = ELASTICSEARCH.bulk(cks, idxnm)
+            if es_r:
+                aborted.set()
+                continue
+            indexed += len(cks)
+            callback(prog=0.7 + 0.2 * indexed / stat["chunks"] if stat["sliced"] else None,
+                     msg="")
+    except SystemExit:
+        # Canceled while indexing, take back what is already in ES.
+        if indexed or chunk_ids:
+            remove_chunks(r, idxnm)
+        raise
+    finally:
+        aborted.set()
+        if ingesting:
+            ELASTICSEARCH.endIngest(idxnm)
+    slicer.join()
+    embedder.join()
+    cron_logger.info("Pipeline elapsed({}): {}".format(r["name"], timer()-st))
+
+    if stat["failed"]:
+        if indexed:
+            remove_chunks(r, idxnm)
+        return False
+    if es_r:
+        callback(-1, "Index failure!")
+        remove_chunks(r, idxnm)
+        cron_logger.error(str(es_r))
+        return True
+    if not stat["chunks"]:
+        callback(1., "No chunk! Done!")
+        return True
+    if TaskService.do_cancel(r["id"]):
+        remove_chunks(r, idxnm)
+        return False
+    callback(1., "Done!")
+    DocumentService.increment_chunk_num(
+        r["doc_id"], r["kb_id"], stat["tk_count"], len(chunk_ids), 0)
+    cron_logger.info(
+        "Chunk doc({}), token({}), chunks({}), elapsed:{}".format(
+            r["id"], stat["tk_count"], stat["chunks"], timer()-st))
+    return True
+
+
 def main(comm, mod):
     tm_fnm = os.path.join(
         get_project_base_directory(),
@@ -257,64 +606,57 @@ def main(comm, mod):
 
     tmf = open(tm_fnm, "a+")
     for _, r in rows.iterrows():
-        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
-        #callback(random.random()/10., "Task has been received.")
+        INFLIGHT.add(r["id"])
         try:
-            embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
-        except Exception as e:
-            traceback.print_stack(e)
-            callback(prog=-1, msg=str(e))
-            continue
-
-        st = timer()
-        cks = build(r)
-        cron_logger.info("Build chunks({}): {}".format(r["name"], timer()-st))
-        if cks is None:
-            continue
-        if not cks:
-            tmf.write(str(r["update_time"]) + "\n")
-            callback(1., "No chunk! Done!")
-            continue
-        # TODO: exception handler
-        ## set_progress(r["did"], -1, "ERROR: ")
-        callback(
-            msg="Finished slicing files(%d). Start to embedding the content." %
-            len(cks))
-        st = timer()
+            if do_handle_task(r):
+                tmf.write(str(r["update_time"]) + "\n")
+        finally:
+            INFLIGHT.discard(r["id"])
+    tmf.close()
 
-        try:
-            tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
-        except Exception as e:
-            callback(-1, "Embedding error:{}".format(str(e)))
-            cron_logger.error("Embedding error:{}".format(str(e)))
-            tk_count = 0
-        cron_logger.info("Embedding elapsed({}): {}".format(r["name"], timer()-st))
 
-        callback(msg="Finished embedding({})! Start to build index!".format(timer()-st))
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
-        st = timer()
-        es_r = ELASTICSEARCH.bulk(cks, search.index_name(r["tenant_id"]))
-        cron_logger.info("Indexing elapsed({}): {}".format(r["name"], timer()-st))
-        if es_r:
-            callback(-1, "Index failure!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
-        else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+def concurrent_main(comm, mod, slots, until=None):
+    """
+    Keep up to `slots` tasks in flight. Every slot is a thread doing the I/O
+    bound work (fetching, embedding, indexing) while the CPU bound chunking is
+    shipped to a process pool of the same size.
+    Runs forever, or until `until()` is true while no task is in flight.
+    """
+    tm_fnm = os.path.join(
+        get_project_base_directory(),
+        "rag/res",
+        f"{comm}-{mod}.tm")
+    # Fork the chunk workers before any thread or DB connection exists.
+    chunk_pool = Pool(processes=slots)
+    threading.Thread(target=heartbeat, daemon=True).start()
+    running = {}
+    with ThreadPoolExecutor(max_workers=slots) as exe:
+        while True:
+            free = slots - len(running)
+            if free > 0:
+                rows = collect(comm, mod, findMaxTm(tm_fnm), free)
+                for _, r in rows.iterrows():
+                    INFLIGHT.add(r["id"])
+                    running[exe.submit(do_handle_task, r, chunk_pool)] = r
+            if not running:
+                if until is not None and until():
+                    break
                 continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{}".format(
-                    r["id"], tk_count, len(cks), timer()-st))
-
-        tmf.write(str(r["update_time"]) + "\n")
-    tmf.close()
+
+            done, _ = wait(list(running.keys()), timeout=1, return_when=FIRST_COMPLETED)
+            for f in done:
+                r = running.pop(f)
+                INFLIGHT.discard(r["id"])
+                e = f.exception()
+                if e is not None:
+                    if not isinstance(e, SystemExit):
+                        cron_logger.error("Task({}) exception: {}".format(r["id"], str(e)))
+                    continue
+                if f.result():
+                    with open(tm_fnm, "a+") as tmf:
+                        tmf.write(str(r["update_time"]) + "\n")
+            close_connection()
+    chunk_pool.terminate()
 
 
 if __name__ == "__main__":
@@ -325,6 +667,10 @@ if __name__ == "__main__":
 
     #from mpi4py import MPI
     #comm = MPI.COMM_WORLD
+    slots = int(TASK_EXECUTOR.get("slots", 1))
+    if slots > 1:
+        concurrent_main(int(sys.argv[2]), int(sys.argv[1]), slots)
+    threading.Thread(target=heartbeat, daemon=True).start()
     while True:
         main(int(sys.argv[2]), int(sys.argv[1]))
         close_connection()
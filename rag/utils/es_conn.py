@@ -1,34 +1,90 @@
 import re
 import json
+import random
+import threading
 import time
-import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import elasticsearch
-from elastic_transport import ConnectionTimeout
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import UpdateByQuery, Search, Index
+from elastic_transport import ConnectionTimeout, ConnectionError as EsConnectionError
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch_dsl import UpdateByQuery, Search, Index, Q
 from rag.settings import es_logger
 from rag import settings
 from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
 
 es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 
+# The deadline of the HTTP request the thread is serving, see HuEs.setDeadline().
+_local = threading.local()
+
+
+def backoff(attempt, base=.5, cap=10.):
+    # Exponential, with jitter so the retries of many threads spread out.
+    return min(cap, base * 2 ** attempt) * (.5 + random.random() / 2)
+
+
+class SearchError(Exception):
+    """
+    A search of an _msearch which failed, with the HTTP status and the error
+    ES answered it with.
+    """
+
+    def __init__(self, status_code, error):
+        super().__init__(json.dumps(error, ensure_ascii=False))
+        self.status_code = status_code
+        self.error = error
+
 
 @singleton
 class HuEs:
+    # Key of the count of the tasks ingesting into an index, by index name.
+    INGESTING = "es:ingesting:"
+    VECTOR_FIELDS = ["q_384_vec", "q_512_vec", "q_768_vec", "q_1024_vec", "q_1536_vec"]
+    # Reads the vector of a chunk from its doc values.
+    VECTOR_SCRIPT = """
+        for (f in params.fields) {
+            if (doc.containsKey(f) && doc[f].size() > 0) { return doc[f].vectorValue; }
+        }
+        return null;
+    """
+
     def __init__(self):
         self.info = {}
+        self.request_timeout = float(settings.ES.get("request_timeout", 600))
+        self.request_deadline = float(settings.ES.get("request_deadline", 0))
+        self.conn_lock = threading.Lock()
         self.conn()
         self.idxnm = settings.ES.get("index_name", "")
+        self.search_timeout = float(settings.ES.get("search_timeout", 10))
+        self.eager_fallback = bool(settings.ES.get("eager_fallback", False))
+        self.bulk_size = int(settings.ES.get("bulk_size", 500))
+        self.bulk_bytes = int(settings.ES.get("bulk_bytes", 10 * 1024 * 1024))
+        self.bulk_threads = max(1, int(settings.ES.get("bulk_threads", 4)))
+        self.bulk_retries = int(settings.ES.get("bulk_retries", 3))
+        self.refresh_interval = settings.ES.get("refresh_interval", "1000ms")
+        self.ingest_refresh_interval = settings.ES.get("ingest_refresh_interval", "30s")
+        self.ingesting = {}
+        self.lock = threading.Lock()
+        self.vector_index_options = settings.ES.get("vector_index_options") or {}
+        self.vector_in_source = bool(settings.ES.get("vector_in_source", True))
         if not self.es.ping():
             raise Exception("Can't connect to ES cluster")
 
     def conn(self):
         for _ in range(10):
             try:
+                sniff = bool(settings.ES.get("sniff", False))
                 self.es = Elasticsearch(
                     settings.ES["hosts"].split(","),
-                    timeout=600
+                    request_timeout=self.request_timeout,
+                    connections_per_node=int(settings.ES.get("connections_per_node", 32)),
+                    max_retries=int(settings.ES.get("max_retries", 3)),
+                    retry_on_timeout=True,
+                    sniff_on_start=sniff,
+                    sniff_on_node_failure=sniff,
+                    min_delay_between_sniffing=60
                 )
                 if self.es:
                     self.info = self.es.info()
@@ -38,6 +94,51 @@ class HuEs:
                 es_logger.error("Fail to connect to es: " + str(e))
                 time.sleep(1)
 
+    def reconnect(self, e):
+        """
+        Tells whether a call failing with e is worth retrying. Only a lost
+        connection makes a new client; on any other error the pooled
+        connections are kept.
+        """
+        if isinstance(e, ConnectionTimeout) or re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
+            return True
+        if not isinstance(e, EsConnectionError):
+            return False
+        es = self.es
+        with self.conn_lock:
+            # Once for all the threads which lost the same client.
+            if self.es is es:
+                self.conn()
+        return True
+
+    def setDeadline(self, seconds):
+        """
+        Bounds the ES calls of the current thread, e.g. those made for the
+        HTTP request it serves, to `seconds` from now. None lifts the bound.
+        """
+        _local.deadline = time.time() + float(seconds) if seconds else None
+
+    def budget(self, timeout=None):
+        """
+        Seconds the next call may take: timeout, or request_timeout, cut to
+        what is left before the deadline of the thread.
+        """
+        timeout = float(timeout) if timeout else self.request_timeout
+        deadline = getattr(_local, "deadline", None)
+        if deadline is None:
+            return timeout
+        left = deadline - time.time()
+        if left <= 0:
+            raise TimeoutError("ES call past the deadline of the request.")
+        return min(timeout, left)
+
+    def client(self, timeout=None):
+        t = self.budget(timeout)
+        if getattr(_local, "deadline", None) is None:
+            return self.es.options(request_timeout=t)
+        # A retry would run past the deadline.
+        return self.es.options(request_timeout=t, retry_on_timeout=False)
+
     def version(self):
         v = self.info.get("version", {"number": "5.6"})
         v = v["number"].split(".")[0]
@@ -45,29 +146,37 @@ class HuEs:
 
     def upsert(self, df, idxnm=""):
         res = []
+        if not self.vector_in_source:
+            # The update rebuilds the doc from _source, which doesn't keep the
+            # vectors, so they are passed back in.
+            ids = [d["id"] for d in df if not any(re.match(r"q_[0-9]+_vec$", k) for k in d)]
+            vecs = self.getVectors(Q("ids", values=ids), idxnm) if ids else {}
+            for d in df:
+                if vecs.get(d["id"]):
+                    d["q_%d_vec" % len(vecs[d["id"]])] = vecs[d["id"]]
         for d in df:
             id = d["id"]
             del d["id"]
             d = {"doc": d, "doc_as_upsert": "true"}
             T = False
-            for _ in range(10):
+            for i in range(10):
                 try:
                     if not self.version():
-                        r = self.es.update(
+                        r = self.client().update(
                             index=(
                                 self.idxnm if not idxnm else idxnm),
                             body=d,
                             id=id,
                             doc_type="doc",
-                            refresh=True,
+                            refresh=False,
                             retry_on_conflict=100)
                     else:
-                        r = self.es.update(
+                        r = self.client().update(
                             index=(
                                 self.idxnm if not idxnm else idxnm),
                             body=d,
                             id=id,
-                            refresh=True,
+                            refresh=False,
                             retry_on_conflict=100)
                     es_logger.info("Successfully upsert: %s" % id)
                     T = True
@@ -75,11 +184,9 @@ class HuEs:
                 except Exception as e:
                     es_logger.warning("Fail to index: " +
                                       json.dumps(d, ensure_ascii=False) + str(e))
-                    if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                        time.sleep(3)
-                        continue
-                    self.conn()
-                    T = False
+                    if not self.reconnect(e):
+                        break
+                    time.sleep(backoff(i))
 
             if not T:
                 res.append(d)
@@ -94,139 +201,120 @@ class HuEs:
                 d["id"] = id
                 d["_index"] = self.idxnm
 
+        # One refresh for all the docs, rather than one each.
+        self.refresh(idxnm)
         if not res:
             return True
         return False
 
     def bulk(self, df, idx_nm=None):
-        ids, acts = {}, []
-        for d in df:
-            id = d["id"] if "id" in d else d["_id"]
-            ids[id] = copy.deepcopy(d)
-            ids[id]["_index"] = self.idxnm if not idx_nm else idx_nm
-            if "id" in d:
-                del d["id"]
-            if "_id" in d:
-                del d["_id"]
-            acts.append(
-                {"update": {"_id": id, "_index": ids[id]["_index"]}, "retry_on_conflict": 100})
-            acts.append({"doc": d, "doc_as_upsert": "true"})
-
-        res = []
-        for _ in range(100):
-            try:
-                if elasticsearch.__version__[0] < 8:
-                    r = self.es.bulk(
-                        index=(
-                            self.idxnm if not idx_nm else idx_nm),
-                        body=acts,
-                        refresh=False,
-                        timeout="600s")
-                else:
-                    r = self.es.bulk(index=(self.idxnm if not idx_nm else
-                                            idx_nm), operations=acts,
-                                     refresh=False, timeout="600s")
-                if re.search(r"False", str(r["errors"]), re.IGNORECASE):
-                    return res
-
-                for it in r["items"]:
-                    if "error" in it["update"]:
-                        res.append(str(it["update"]["_id"]) +
-                                   ":" + str(it["update"]["error"]))
-
-                return res
-            except Exception as e:
-                es_logger.warn("Fail to bulk: " + str(e))
-                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                    time.sleep(3)
-                    continue
-                self.conn()
-
-        return res
-
-    def bulk4script(self, df):
-        ids, acts = {}, []
-        for d in df:
-            id = d["id"]
-            ids[id] = copy.deepcopy(d["raw"])
-            acts.append({"update": {"_id": id, "_index": self.idxnm}})
-            acts.append(d["script"])
-            es_logger.info("bulk upsert: %s" % id)
-
+        """
+        Upserts the docs and returns the errors of those failing, as "id:error".
+        The docs go in requests of at most `bulk_size` docs and `bulk_bytes`
+        bytes, `bulk_threads` requests at a time. Only the failed items are
+        retried, with backoff: those throttled by ES and those whose request
+        failed on the connection.
+        """
+        idx_nm = self.idxnm if not idx_nm else idx_nm
+        acts = [{"_op_type": "update",
+                 "_index": idx_nm,
+                 "_id": d["id"] if "id" in d else d["_id"],
+                 "retry_on_conflict": 100,
+                 "doc": {k: v for k, v in d.items() if k not in ("id", "_id")},
+                 "doc_as_upsert": True} for d in df]
+        threads = min(self.bulk_threads, (len(acts) + self.bulk_size - 1) // self.bulk_size)
+        if threads <= 1:
+            return self._bulk(acts)
+        size = (len(acts) + threads - 1) // threads
+        with ThreadPoolExecutor(threads) as pool:
+            return sum(pool.map(self._bulk, [acts[i:i + size] for i in range(0, len(acts), size)]), [])
+
+    def _bulk(self, acts):
         res = []
-        for _ in range(10):
+        for attempt in range(self.bulk_retries + 1):
+            done = set()
             try:
-                if not self.version():
-                    r = self.es.bulk(
-                        index=self.idxnm,
-                        body=acts,
-                        refresh=False,
-                        timeout="600s",
-                        doc_type="doc")
-                else:
-                    r = self.es.bulk(
-                        index=self.idxnm,
-                        body=acts,
-                        refresh=False,
-                        timeout="600s")
-                if re.search(r"False", str(r["errors"]), re.IGNORECASE):
-                    return res
-
-                for it in r["items"]:
-                    if "error" in it["update"]:
-                        res.append(str(it["update"]["_id"]))
-
+                for ok, it in helpers.streaming_bulk(self.es, acts,
+                                                     chunk_size=self.bulk_size,
+                                                     max_chunk_bytes=self.bulk_bytes,
+                                                     raise_on_error=False,
+                                                     max_retries=self.bulk_retries,
+                                                     initial_backoff=1,
+                                                     max_backoff=30,
+                                                     refresh=False):
+                    it = it["update"]
+                    done.add(str(it["_id"]))
+                    if not ok:
+                        res.append(str(it["_id"]) + ":" + str(it.get("error")))
                 return res
             except Exception as e:
                 es_logger.warning("Fail to bulk: " + str(e))
-                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                    time.sleep(3)
-                    continue
-                self.conn()
-
-        return res
+                acts = [a for a in acts if str(a["_id"]) not in done]
+                status = getattr(e, "status_code", None)
+                if isinstance(status, int) and status != 429 and status < 500:
+                    break
+                if attempt < self.bulk_retries:
+                    time.sleep(backoff(attempt, 1., 30.))
+        return res + [str(a["_id"]) + ":Fail to bulk" for a in acts]
 
     def rm(self, d):
-        for _ in range(10):
+        """
+        Deletes a doc, or a list of them, and refreshes once after all of them
+        unless tasks are ingesting into the index.
+        """
+        docs = d if isinstance(d, list) else [d]
+        ok = all([self._rm(d) for d in docs])
+        if docs and not self.isIngesting(self.idxnm):
+            self.refresh(self.idxnm)
+        return ok
+
+    def _rm(self, d):
+        for i in range(10):
             try:
                 if not self.version():
-                    r = self.es.delete(
+                    r = self.client().delete(
                         index=self.idxnm,
                         id=d["id"],
                         doc_type="doc",
-                        refresh=True)
+                        refresh=False)
                 else:
-                    r = self.es.delete(
+                    r = self.client().delete(
                         index=self.idxnm,
                         id=d["id"],
-                        refresh=True,
-                        doc_type="_doc")
+                        refresh=False)
                 es_logger.info("Remove %s" % d["id"])
                 return True
             except Exception as e:
                 es_logger.warn("Fail to delete: " + str(d) + str(e))
-                if re.search(r"(Timeout|time out)", str(e), re.IGNORECASE):
-                    time.sleep(3)
-                    continue
                 if re.search(r"(not_found)", str(e), re.IGNORECASE):
                     return True
-                self.conn()
+                if not self.reconnect(e):
+                    break
+                time.sleep(backoff(i))
 
         es_logger.error("Fail to delete: " + str(d))
 
         return False
 
-    def search(self, q, idxnm=None, src=False, timeout="2s"):
+    def search(self, q, idxnm=None, src=False, timeout=None):
+        """
+        timeout is the budget in seconds of the whole call, retries included,
+        `search_timeout` by default.
+        """
         if not isinstance(q, dict):
             q = Search().query(q).to_dict()
+        deadline = time.time() + self.budget(timeout or self.search_timeout)
         for i in range(3):
+            left = deadline - time.time()
+            if left <= 0:
+                break
             try:
-                res = self.es.search(index=(self.idxnm if not idxnm else idxnm),
-                                     body=q,
-                                     timeout=timeout,
-                                     # search_type="dfs_query_then_fetch",
-                                     track_total_hits=True,
-                                     _source=src)
+                res = self.client(left).search(index=(self.idxnm if not idxnm else idxnm),
+                                               body=q,
+                                               timeout="%dms" % int(left * 1000),
+                                               # search_type="dfs_query_then_fetch",
+                                               track_total_hits=True,
+                                               _source=src)
                 if str(res.get("timed_out", "")).lower() == "true":
                     raise Exception("Es Timeout.")
                 return res
@@ -242,6 +330,45 @@ class HuEs:
         es_logger.error("ES search timeout for 3 times!")
         raise Exception("ES search timeout.")
 
+    def msearch(self, qs, idxnm=None, src=False, timeout=None):
+        """
+        Runs the searches in a single round trip and returns their responses
+        in order. timeout is the budget in seconds of the whole call, retries
+        included. A search running out of it returns the hits found so far.
+        """
+        deadline = time.time() + self.budget(timeout or self.search_timeout)
+        body = []
+        for q in qs:
+            if not isinstance(q, dict):
+                q = Search().query(q).to_dict()
+            body.append({"index": (self.idxnm if not idxnm else idxnm)})
+            body.append(dict(q, track_total_hits=True, _source=src))
+        for i in range(3):
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            for q in body[1::2]:
+                q["timeout"] = "%dms" % int(left * 1000)
+            try:
+                res = self.client(left).msearch(body=body)
+            except Exception as e:
+                es_logger.error(
+                    "ES msearch exception: " +
+                    str(e) +
+                    "【Q】：" +
+                    str(qs))
+                if isinstance(e, ConnectionTimeout) or str(e).find("Timeout") > 0:
+                    continue
+                raise e
+            for r in res["responses"]:
+                if "error" in r:
+                    raise SearchError(r.get("status"), r["error"])
+                if str(r.get("timed_out", "")).lower() == "true":
+                    es_logger.warning("ES search ran out of its {}s budget.".format(timeout or self.search_timeout))
+            return res["responses"]
+        es_logger.error("ES msearch timeout!")
+        raise Exception("ES search timeout.")
+
     def sql(self, sql, fetch_size=128, format="json", timeout="2s"):
         for i in range(3):
             try:
@@ -259,8 +386,8 @@ class HuEs:
     def get(self, doc_id, idxnm=None):
         for i in range(3):
             try:
-                res = self.es.get(index=(self.idxnm if not idxnm else idxnm),
-                                     id=doc_id)
+                res = self.client().get(index=(self.idxnm if not idxnm else idxnm),
+                                        id=doc_id)
                 if str(res.get("timed_out", "")).lower() == "true":
                     raise Exception("Es Timeout.")
                 return res
@@ -281,6 +408,8 @@ class HuEs:
         scripts = ""
         for k, v in d.items():
             scripts += "ctx._source.%s = params.%s;" % (str(k), str(k))
+        if not self.vector_in_source:
+            return self._updateWithVectors(q, scripts, d, self.idxnm)
         ubq = ubq.script(source=scripts, params=d)
         ubq = ubq.params(refresh=False)
         ubq = ubq.params(slices=5)
@@ -292,13 +421,17 @@ class HuEs:
             except Exception as e:
                 es_logger.error("ES updateByQuery exception: " +
                                 str(e) + "【Q】：" + str(q.to_dict()))
-                if str(e).find("Timeout") > 0 or str(e).find("Conflict") > 0:
+                if str(e).find("Conflict") > 0:
                     continue
-                self.conn()
+                if not self.reconnect(e):
+                    break
+                time.sleep(backoff(i))
 
         return False
 
     def updateScriptByQuery(self, q, scripts, idxnm=None):
+        if not self.vector_in_source:
+            return self._updateWithVectors(q, scripts, {}, idxnm)
         ubq = UpdateByQuery(
             index=self.idxnm if not idxnm else idxnm).using(
             self.es).query(q)
@@ -313,18 +446,56 @@ class HuEs:
             except Exception as e:
                 es_logger.error("ES updateByQuery exception: " +
                                 str(e) + "【Q】：" + str(q.to_dict()))
-                if str(e).find("Timeout") > 0 or str(e).find("Conflict") > 0:
+                if str(e).find("Conflict") > 0:
                     continue
-                self.conn()
+                if not self.reconnect(e):
+                    break
+                time.sleep(backoff(i))
 
         return False
 
+    def _updateWithVectors(self, q, scripts, params, idxnm=None):
+        # An update by query would rebuild the docs from _source and lose the
+        # vectors, so every doc is updated on its own with its vector passed
+        # back in.
+        idxnm = idxnm if idxnm else self.idxnm
+        scripts += "if (params.vector != null) { ctx._source['q_' + params.vector.size() + '_vec'] = params.vector; }"
+        try:
+            acts = [{"_op_type": "update", "_index": idxnm, "_id": id, "retry_on_conflict": 100,
+                     "script": {"source": scripts, "params": dict(params, vector=v)}}
+                    for id, v in self.getVectors(q, idxnm).items()]
+        except Exception as e:
+            es_logger.error("ES updateByQuery exception: " +
+                            str(e) + "【Q】：" + str(q.to_dict()))
+            return False
+        res = self._bulk(acts)
+        if res:
+            es_logger.error("ES updateByQuery exception: " + str(res[:3]))
+        self.refresh(idxnm)
+        return not res
+
+    def getVectors(self, q, idxnm=None):
+        """
+        The vectors of the chunks matching q, by chunk id, read from the doc
+        values so it works whether or not _source keeps them. None for a chunk
+        without a vector.
+        """
+        body = {"query": q if isinstance(q, dict) else q.to_dict(),
+                "_source": False,
+                "script_fields": {"vector": {"script": {"source": self.VECTOR_SCRIPT,
+                                                        "params": {"fields": self.VECTOR_FIELDS}}}}}
+        return {h["_id"]: h.get("fields", {}).get("vector")
+                for h in helpers.scan(self.es, query=body, index=idxnm if idxnm else self.idxnm,
+                                      size=1000, request_timeout=self.budget(600))}
+
     def deleteByQuery(self, query, idxnm=""):
+        # While tasks ingest into the index, the deletion shows at their refresh.
+        refresh = not self.isIngesting(idxnm if idxnm else self.idxnm)
         for i in range(3):
             try:
                 r = self.es.delete_by_query(
                     index=idxnm if idxnm else self.idxnm,
-                    refresh = True,
+                    refresh = refresh,
                 body=Search().query(query).to_dict())
                 return True
             except Exception as e:
@@ -336,32 +507,6 @@ class HuEs:
 
         return False
 
-    def update(self, id, script, routing=None):
-        for i in range(3):
-            try:
-                if not self.version():
-                    r = self.es.update(
-                        index=self.idxnm,
-                        id=id,
-                        body=json.dumps(
-                            script,
-                            ensure_ascii=False),
-                        doc_type="doc",
-                        routing=routing,
-                        refresh=False)
-                else:
-                    r = self.es.update(index=self.idxnm, id=id, body=json.dumps(script, ensure_ascii=False),
-                                       routing=routing, refresh=False)  # , doc_type="_doc")
-                return True
-            except Exception as e:
-                es_logger.error(
-                    "ES update exception: " + str(e) + " id：" + str(id) + ", version:" + str(self.version()) +
-                    json.dumps(script, ensure_ascii=False))
-                if str(e).find("Timeout") > 0:
-                    continue
-
-        return False
-
     def indexExist(self, idxnm):
         s = Index(idxnm if idxnm else self.idxnm, self.es)
         for i in range(3):
@@ -385,7 +530,23 @@ class HuEs:
                     continue
         return False
 
+    def vectorMapping(self, mapping):
+        """
+        Applies `vector_index_options`, e.g. {"type": "int8_hnsw"}, to the
+        dense_vector templates of the mapping, and keeps the vectors out of
+        _source unless `vector_in_source`. They are still indexed, and kept
+        as doc values for scripts and getVectors().
+        """
+        for t in mapping["mappings"].get("dynamic_templates", []):
+            for tmpl in t.values():
+                if tmpl["mapping"].get("type") == "dense_vector" and self.vector_index_options:
+                    tmpl["mapping"]["index_options"] = dict(self.vector_index_options)
+        if not self.vector_in_source:
+            mapping["mappings"]["_source"] = {"excludes": ["q_*_vec"]}
+        return mapping
+
     def createIdx(self, idxnm, mapping):
+        mapping = self.vectorMapping(mapping)
         try:
             if elasticsearch.__version__[0] < 8:
                 return self.es.indices.create(idxnm, body=mapping)
@@ -396,6 +557,107 @@ class HuEs:
         except Exception as e:
             es_logger.error("ES create index error %s ----%s" % (idxnm, str(e)))
 
+    def putAlias(self, idxnm, alias, routing=None, filter=None):
+        try:
+            return self.es.indices.put_alias(index=idxnm, name=alias, routing=routing, filter=filter)
+        except Exception as e:
+            es_logger.error("ES put alias error %s ----%s" % (alias, str(e)))
+
+    def concreteIndex(self, idxnm):
+        """
+        The index an alias points at, e.g. the pool of a tenant placed by
+        PooledPlacement. idxnm itself when it is an index.
+        """
+        try:
+            res = self.es.indices.get_alias(name=idxnm)
+            if len(res) == 1:
+                return list(res.keys())[0]
+        except elasticsearch.NotFoundError:
+            pass
+        except Exception as e:
+            es_logger.error("ES get alias error %s ----%s" % (idxnm, str(e)))
+        return idxnm
+
+    def refresh(self, idxnm=None):
+        try:
+            self.es.indices.refresh(index=idxnm if idxnm else self.idxnm)
+            return True
+        except Exception as e:
+            es_logger.error("ES refresh index error %s ----%s" % (idxnm, str(e)))
+        return False
+
+    def setRefreshInterval(self, idxnm, interval):
+        try:
+            if elasticsearch.__version__[0] < 8:
+                self.es.indices.put_settings(index=idxnm, body={"index": {"refresh_interval": interval}})
+            else:
+                self.es.indices.put_settings(index=idxnm, settings={"index": {"refresh_interval": interval}})
+            es_logger.info("Refresh interval of %s: %s" % (idxnm, interval))
+            return True
+        except Exception as e:
+            es_logger.error("ES set refresh interval error %s ----%s" % (idxnm, str(e)))
+        return False
+
+    def _ingest_count(self, idxnm, delta):
+        # Counted in Redis, so all the task executors share it. The key expires,
+        # so a count leaked by a crashed executor doesn't last.
+        n = REDIS_CONN.incr(self.INGESTING + idxnm, delta, 3600) if REDIS_CONN.is_alive() else None
+        if n is not None:
+            return n
+        with self.lock:
+            self.ingesting[idxnm] = self.ingesting.get(idxnm, 0) + delta
+            return self.ingesting[idxnm]
+
+    def isIngesting(self, idxnm):
+        if not self.ingest_refresh_interval:
+            return False
+        idxnm = self.concreteIndex(idxnm)
+        if REDIS_CONN.is_alive():
+            return int(REDIS_CONN.get(self.INGESTING + idxnm) or 0) > 0
+        with self.lock:
+            return self.ingesting.get(idxnm, 0) > 0
+
+    def restoreRefreshIntervals(self):
+        """
+        Restores the refresh interval of the indices left relaxed by the
+        tasks of a crashed executor, once their count has expired in Redis.
+        Returns the indices restored.
+        """
+        if not self.ingest_refresh_interval or not REDIS_CONN.is_alive():
+            return []
+        res = self.es.indices.get_settings(index="_all", name="index.refresh_interval", flat_settings=True)
+        idxnms = []
+        for idxnm, s in res.items():
+            if s.get("settings", {}).get("index.refresh_interval") != self.ingest_refresh_interval:
+                continue
+            if int(REDIS_CONN.get(self.INGESTING + idxnm) or 0) > 0:
+                continue
+            if self.setRefreshInterval(idxnm, self.refresh_interval):
+                idxnms.append(idxnm)
+        return idxnms
+
+    def beginIngest(self, idxnm=None):
+        """
+        Called by a task before it bulk indexes chunks into the index. The
+        first of the tasks ingesting into the index relaxes its refresh
+        interval to `ingest_refresh_interval`. The tasks of all the tenants
+        sharing a pool count as ingesting into the pool.
+        """
+        idxnm = self.concreteIndex(idxnm if idxnm else self.idxnm)
+        if self.ingest_refresh_interval and self._ingest_count(idxnm, 1) <= 1:
+            self.setRefreshInterval(idxnm, self.ingest_refresh_interval)
+
+    def endIngest(self, idxnm=None):
+        """
+        The last of the tasks ingesting into the index restores its refresh
+        interval. The index is refreshed either way, so the chunks of a task
+        are searchable once it is done.
+        """
+        idxnm = self.concreteIndex(idxnm if idxnm else self.idxnm)
+        if self.ingest_refresh_interval and self._ingest_count(idxnm, -1) <= 0:
+            self.setRefreshInterval(idxnm, self.refresh_interval)
+        self.refresh(idxnm)
+
     def deleteIdx(self, idxnm):
         try:
             return self.es.indices.delete(idxnm, allow_no_indices=True)
@@ -0,0 +1,102 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import math
+import zlib
+
+from rag.settings import INDEX_PLACEMENT as CONFIG, es_logger
+from rag.utils.es_conn import ELASTICSEARCH
+
+
+class DedicatedPlacement:
+    """
+    Every tenant has an index of its own, named index_name(tenant_id), with
+    enough shards for the chunks it already has.
+    """
+
+    def __init__(self, es, chunks_per_shard=2000000, max_shards=16, **kwargs):
+        self.es = es
+        self.chunks_per_shard = int(chunks_per_shard)
+        self.max_shards = int(max_shards)
+
+    def shards(self, chunk_num, mapping):
+        shards = int(mapping["settings"]["index"].get("number_of_shards", 1))
+        return min(self.max_shards, max(shards, math.ceil(chunk_num / self.chunks_per_shard)))
+
+    def create(self, idxnm, tenant_id, mapping, chunk_num=0):
+        mapping["settings"]["index"]["number_of_shards"] = self.shards(chunk_num, mapping)
+        return self.es.createIdx(idxnm, mapping)
+
+
+class PooledPlacement(DedicatedPlacement):
+    """
+    Tenants with fewer than `dedicated_chunks` chunks share `pools` indices.
+    index_name(tenant_id) is then an alias on the tenant's pool, filtered by
+    and routed by the tenant id. So every search, get, bulk, update or delete
+    by query made through it sees only the chunks of the tenant, and touches
+    the single shard holding them, without the callers knowing.
+    Larger tenants get dedicated indices.
+    """
+
+    def __init__(self, es, pools=8, pool_shards=4, dedicated_chunks=1000000, **kwargs):
+        super().__init__(es, **kwargs)
+        self.pools = int(pools)
+        self.pool_shards = int(pool_shards)
+        self.dedicated_chunks = int(dedicated_chunks)
+
+    def pool(self, tenant_id):
+        return "ragflow_pool_%d" % (zlib.crc32(tenant_id.encode("utf-8")) % self.pools)
+
+    def create(self, idxnm, tenant_id, mapping, chunk_num=0):
+        if chunk_num >= self.dedicated_chunks:
+            return super().create(idxnm, tenant_id, mapping, chunk_num)
+        pool = self.pool(tenant_id)
+        if not self.es.indexExist(pool):
+            mapping["settings"]["index"]["number_of_shards"] = self.pool_shards
+            # Nothing may be indexed into a pool but through an alias.
+            mapping["mappings"]["_routing"] = {"required": True}
+            self.es.createIdx(pool, mapping)
+        return self.es.putAlias(pool, idxnm, routing=tenant_id, filter={"term": {"_routing": tenant_id}})
+
+    def promote(self, idxnm, tenant_id, mapping, chunk_num):
+        """
+        Moves a tenant which has outgrown its pool to a dedicated index and
+        points index_name(tenant_id) at it. Nothing should be indexed into
+        the tenant while it runs.
+        """
+        # Reindexing copies _source, so the vectors have to be in it.
+        assert self.es.vector_in_source, "Can't move the chunks of a tenant without their vectors in _source"
+        pool = self.pool(tenant_id)
+        dest = idxnm + "_dedicated"
+        super().create(dest, tenant_id, mapping, chunk_num)
+        es = self.es.es.options(request_timeout=24 * 3600)
+        es.reindex(source={"index": pool, "query": {"term": {"_routing": tenant_id}}},
+                   dest={"index": dest, "routing": "discard"}, refresh=True, wait_for_completion=True)
+        es.indices.update_aliases(actions=[
+            {"remove": {"index": pool, "alias": idxnm}},
+            {"add": {"index": dest, "alias": idxnm}}])
+        es.delete_by_query(index=pool, query={"term": {"_routing": tenant_id}},
+                           routing=tenant_id, conflicts="proceed")
+        es_logger.info("Tenant {} moved from {} to {}".format(tenant_id, pool, dest))
+        return dest
+
+
+PLACEMENTS = {
+    "dedicated": DedicatedPlacement,
+    "pooled": PooledPlacement
+}
+
+INDEX_PLACEMENT = PLACEMENTS[CONFIG.get("strategy", "dedicated")](
+    ELASTICSEARCH, **{k: v for k, v in CONFIG.items() if k != "strategy"})
@@ -51,5 +51,57 @@ class RedisDB:
             self.__open__()
         return False
 
+    def mget(self, keys):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("[EXCEPTION]mget" + str(keys[:1]) + "||" + str(e))
+            self.__open__()
+
+    def mset(self, mapping, exp=3600):
+        try:
+            pipe = self.REDIS.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipe.set(k, v, exp)
+            pipe.execute()
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]mset" + str(list(mapping.keys())[:1]) + "||" + str(e))
+            self.__open__()
+        return False
+
+    def incr(self, k, amount=1, exp=None):
+        try:
+            if not exp:
+                return self.REDIS.incr(k, amount)
+            pipe = self.REDIS.pipeline(transaction=True)
+            pipe.incr(k, amount)
+            pipe.expire(k, exp)
+            return pipe.execute()[0]
+        except Exception as e:
+            logging.warning("[EXCEPTION]incr" + str(k) + "||" + str(e))
+            self.__open__()
+
+    def sadd(self, k, *members):
+        try:
+            self.REDIS.sadd(k, *members)
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]sadd" + str(k) + "||" + str(e))
+            self.__open__()
+        return False
+
+    def spop(self, k, count=1):
+        """
+        Pop up to `count` members of a set. None means Redis is unavailable.
+        """
+        if not self.REDIS: return
+        try:
+            return self.REDIS.spop(k, count)
+        except Exception as e:
+            logging.warning("[EXCEPTION]spop" + str(k) + "||" + str(e))
+            self.__open__()
+
 
 REDIS_CONN = RedisDB()
\ No newline at end of file
@@ -0,0 +1,98 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import json
+import random
+from timeit import default_timer as timer
+
+import numpy as np
+
+from api.utils.file_utils import get_project_base_directory
+from rag.utils import ELASTICSEARCH
+
+
+def chunks(n, dim, prefix):
+    words = ["retrieval", "augmented", "generation", "chunk", "vector", "index", "segment", "refresh"]
+    for i in range(n):
+        txt = " ".join(random.choice(words) for _ in range(120))
+        yield {"_id": "{}{}".format(prefix, i), "doc_id": prefix, "kb_id": "t_es_ingest",
+               "content_with_weight": txt, "content_ltks": txt,
+               "q_%d_vec" % dim: np.random.rand(dim).astype(np.float32).tolist()}
+
+
+def bulk(idxnm, args, ingest):
+    docs = list(chunks(args.docs, args.dim, "ingest" if ingest else "default"))
+    st = timer()
+    if ingest:
+        ELASTICSEARCH.beginIngest(idxnm)
+    for i in range(0, len(docs), args.batch_size):
+        assert not ELASTICSEARCH.bulk(docs[i:i + args.batch_size], idxnm)
+    if ingest:
+        ELASTICSEARCH.endIngest(idxnm)
+    else:
+        ELASTICSEARCH.refresh(idxnm)
+    return timer() - st
+
+
+def upsert(idxnm, args, batched):
+    docs = [{"id": "default{}".format(i), "available_int": 0} for i in range(args.upserts)]
+    st = timer()
+    if batched:
+        ELASTICSEARCH.upsert(docs, idxnm)
+    else:
+        for d in docs:
+            ELASTICSEARCH.es.update(index=idxnm, id=d["id"], body={"doc": {"available_int": 1}},
+                                    refresh=True, retry_on_conflict=100)
+    return timer() - st
+
+
+def main(args):
+    idxnm = "t_es_ingest_{}".format(os.getpid())
+    mapping = json.load(open(os.path.join(get_project_base_directory(), "conf", "mapping.json"), "r"))
+    ELASTICSEARCH.createIdx(idxnm, mapping)
+    try:
+        print("{:>28} {:>10} {:>10}".format("", "seconds", "docs/s"))
+        for name, el, n in [
+            ("bulk, refresh 1000ms", bulk(idxnm, args, False), args.docs),
+            ("bulk, ingest mode", bulk(idxnm, args, True), args.docs),
+            ("upsert, refresh per doc", upsert(idxnm, args, False), args.upserts),
+            ("upsert, one refresh", upsert(idxnm, args, True), args.upserts),
+        ]:
+            print("{:>28} {:>10.2f} {:>10.1f}".format(name, el, n / el))
+    finally:
+        ELASTICSEARCH.es.indices.delete(index=idxnm)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Indexing throughput with and without the ingestion mode, against the ES in service_conf.yaml.")
+    parser.add_argument('--docs', help="Chunks to bulk index. Default: 20000", type=int, default=20000)
+    parser.add_argument('--dim', help="Dimension of the vectors. Default: 1024", type=int, default=1024)
+    parser.add_argument('--batch_size', help="Chunks a bulk call, as the task executor does. Default: 64",
+                        type=int, default=64)
+    parser.add_argument('--upserts', help="Chunks to upsert one by one. Default: 500", type=int, default=500)
+    args = parser.parse_args()
+    main(args)
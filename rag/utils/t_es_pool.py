@@ -0,0 +1,75 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import sys
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(
+            os.path.dirname(
+                os.path.abspath(__file__)),
+            '../../')))
+
+import argparse
+import random
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+import numpy as np
+
+from rag.utils import ELASTICSEARCH
+
+
+def request(args, words):
+    # As an API server thread does: a deadline for the request, then searches.
+    ELASTICSEARCH.setDeadline(args.deadline)
+    st = timer()
+    try:
+        q = {"query": {"match": {"content_ltks": " ".join(random.sample(words, 3))}}, "size": 30}
+        ELASTICSEARCH.msearch([q, q], idxnm=args.index)
+        return timer() - st, None
+    except Exception as e:
+        return timer() - st, e
+    finally:
+        ELASTICSEARCH.setDeadline(None)
+
+
+def main(args):
+    words = args.words.split(",")
+    print("{:>8} {:>10} {:>10} {:>10} {:>8}".format("threads", "req/s", "p50 ms", "p99 ms", "errors"))
+    for threads in [int(t) for t in args.threads.split(",")]:
+        with ThreadPoolExecutor(threads) as pool:
+            st = timer()
+            res = list(pool.map(lambda _: request(args, words), range(args.requests)))
+            el = timer() - st
+        lat = np.array([r[0] for r in res]) * 1000
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+            threads, len(res) / el, np.percentile(lat, 50), np.percentile(lat, 99),
+            len([r for r in res if r[1] is not None])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Search throughput and latency of HuEs under concurrent API server threads.")
+    parser.add_argument('--index', help="Index to search, e.g. ragflow_<tenant id>", required=True)
+    parser.add_argument('--words', help="Comma separated words the queries are made of",
+                        default="retrieval,augmented,generation,chunk,vector,index,segment,refresh")
+    parser.add_argument('--requests', help="Requests per thread count. Default: 2000", type=int, default=2000)
+    parser.add_argument('--threads', help="Comma separated thread counts. Default: '1,8,32,64'",
+                        default="1,8,32,64")
+    parser.add_argument('--deadline', help="Seconds every request may take. Default: 5", type=float, default=5)
+    args = parser.parse_args()
+    main(args)